@@ -93,28 +93,57 @@ def return_args(root, choice, pars=set_2m_loo_cut, grade_list=grades_cut):
     parser.add_argument('--save_path', type=str, default=root + r'/Grading/Results/' + choice)
     parser.add_argument('--grade_path', type=str, default=root + r'/Grading/trimmed_grades_' + choice + '.xlsx')
     parser.add_argument('--n_subvolumes', type=int, default=1)
+    parser.add_argument('--subvolumes_x', type=int, default=3)
+    parser.add_argument('--subvolumes_y', type=int, default=3)
+    parser.add_argument('--subimage_size', type=int, default=400)
+    parser.add_argument('--subimage_features', type=str, choices=['files', 'integral'], default='files')
     parser.add_argument('--logistic_limit', type=int, default=1)
     parser.add_argument('--log_pred_threshold', type=int, default=0.5)
     parser.add_argument('--n_jobs', type=int, default=10)
     parser.add_argument('--n_components', type=int, default=3)
     parser.add_argument('--str_components', type=str, default='90')
+    parser.add_argument('--pca_solver', type=str, choices=['auto', 'full', 'arpack', 'randomized', 'incremental'],
+                        default='auto')
+    parser.add_argument('--pca_batch_size', type=int, default=500)  # Samples per batch in incremental PCA
     parser.add_argument('--split', type=str, choices=['loo', 'logo', 'train_test', 'max_pool'], default='logo')
     parser.add_argument('--regression', type=str, choices=['lasso', 'ridge'], default='ridge')
     parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--sweep_regression', type=bool, default=False)  # Loss surface of alpha and n_components
+    parser.add_argument('--sweep_alphas', type=float, nargs='+', default=[0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0])
+    parser.add_argument('--sweep_components', type=int, nargs='+', default=list(range(1, 21)))
     parser.add_argument('--standardization', type=str, choices=['standardize', 'centering'], default='centering')
     parser.add_argument('--convolution', type=bool, default=False)
     parser.add_argument('--normalize_hist', type=bool, default=True)
+    parser.add_argument('--normalization', type=str, choices=['direct', 'separable', 'recursive'], default='direct')
     parser.add_argument('--save_images', type=bool, default=True)
     parser.add_argument('--train_regression', type=bool, default=True)
     parser.add_argument('--auto_crop', type=bool, default=True)
     parser.add_argument('--GUI', type=bool, default=False)
     parser.add_argument('--median_filter', type=bool, default=False)
+    parser.add_argument('--median_method', type=str, choices=['scipy', 'histogram'], default='scipy')
+    parser.add_argument('--median_threads', type=int, default=1)  # Total threads for median filtering
+    parser.add_argument('--lbp_backend', type=str, choices=['numpy', 'numba'], default='numpy')
+    parser.add_argument('--feature_cache', type=str, default=None)  # Directory for cached MRELBP features
+    parser.add_argument('--feature_cache_size', type=int, default=2 ** 30)  # Bytes
     parser.add_argument('--convert_grades', type=str, choices=['exp', 'log', 'none'], default='none')
     parser.add_argument('--binary_model', type=str, choices=['LOG', 'RF'], default='LOG')
+    parser.add_argument('--deferred_shap', type=bool, default=True)  # SHAP values in background worker
     parser.add_argument('--pars', type=dict, default=pars)
     parser.add_argument('--grades_used', type=str, default=grade_list)
     parser.add_argument('--seed', type=int, default=42)  # Random seed
     parser.add_argument('--n_pars', type=int, default=100)  # Parameter optimization
+    parser.add_argument('--hyperopt_jobs', type=int, default=1)  # Concurrent hyperopt trials
+    parser.add_argument('--fold_jobs', type=int, default=1)  # Parallel LOO folds in hyperopt
+    parser.add_argument('--warm_start_points', type=int, default=0)  # Warm start hyperopt from previous fold
+    parser.add_argument('--warm_start_evals', type=int, default=20)
+    parser.add_argument('--convergence_step', type=int, default=10)
+    parser.add_argument('--search', type=str, choices=['loo', 'halving'], default='loo')  # Training script search
+    parser.add_argument('--halving_eta', type=int, default=3)  # Successive halving
+    parser.add_argument('--halving_min_samples', type=int, default=10)
+    parser.add_argument('--halving_min_size', type=int, default=200)
+    parser.add_argument('--checkpoint', type=str, default=None)  # Directory for optimization checkpoints
+    parser.add_argument('--checkpoint_every', type=int, default=10)
+    parser.add_argument('--resume', type=bool, default=False)
     parser.add_argument('--n_bootstrap', type=int, default=2000)  # Bootstrapping AUC
     parser.add_argument('--use_PCA', type=bool, default=True)  # Use of dimensionality reduction
     return parser.parse_args()
@@ -7,19 +7,20 @@ import pandas as pd
 
 from time import time
 from tqdm import tqdm
-from joblib import Parallel, delayed
-from scipy.signal import medfilt2d
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.metrics import confusion_matrix, mean_squared_error, roc_auc_score, r2_score, \
     precision_recall_fscore_support, f1_score, accuracy_score
 from scipy.stats import spearmanr, wilcoxon
 
-from components.grading.local_binary_pattern import local_normalize_abs as local_standard, MRELBP, Conv_MRELBP
+from components.grading.local_binary_pattern import local_normalize_abs as local_standard, MRELBP, Conv_MRELBP, \
+    MRELBP_batch, MRELBP_fused, MRELBP_windows, median_filter, worker_threads
 from components.utilities.load_write import save_excel, load_vois_h5, load_binary_weights, write_binary_weights, \
     load_excel
 from components.grading.pca_regression import scikit_pca, regress_logo, regress_loo, logistic_logo, logistic_loo, \
-    standardize, pca_regress_pipeline_log, rforest_logo, evaluate_model
+    standardize, pca_regress_pipeline_log, rforest_logo, evaluate_model, regression_sweep, compiled_model
+from components.grading.interpretability import feature_names, summary_plots
 from components.utilities.misc import print_images, \
-    auto_corner_crop
+    auto_corner_crop, subimage_windows
 
 
 def pipeline_lbp(args, files, parameters, grade_used):
@@ -39,6 +40,10 @@ def pipeline_lbp(args, files, parameters, grade_used):
         auto_crop = Choice whether to automatically crop deep and calcified input images.
         convolution = Choice whether to use MRELBP pipeline with or without convolution.
         normalize_hist = Choice whether to normalize MRELBP histograms by sum.
+        normalization = Filtering backend for local normalization (direct, separable or recursive).
+        median_method = Median filtering engine (exact scipy or quantized histogram).
+        median_threads = Total number of threads for exact median filtering, shared by the parallel workers.
+        lbp_backend = MRELBP implementation (numpy or fused numba kernel). Numba falls back to numpy if not installed.
         convert_grades = Choice whether to predict optionally exp or log of grades.
         save_path = Path to save images and features.
 
@@ -66,10 +71,32 @@ def pipeline_lbp(args, files, parameters, grade_used):
                                                          for i in range(len(files_input))))  # Iterable
 
         # Calculate features
-        if args.convolution:
+        same_shape = len(set(image.shape for image in images_norm)) == 1
+        threads = worker_threads(args, min(effective_n_jobs(args.n_jobs), len(images_norm)))
+        if not args.convolution and not args.save_images and args.lbp_backend == 'numba':
+            # Fused compiled kernel, no intermediate LBP images
+            features = (Parallel(n_jobs=args.n_jobs)(delayed(MRELBP_fused)  # Initialize
+                        (images_norm[i], parameters,  # LBP parameters
+                         normalize=args.normalize_hist,
+                         median_method=args.median_method,
+                         median_threads=threads)
+                          for i in tqdm(range(len(files_input)), desc='Calculating LBP features')))  # Iterable
+        elif not args.convolution and not args.save_images and same_shape:
+            # Batched MRELBP, one stack of images per worker
+            chunks = np.array_split(np.arange(len(images_norm)),
+                                    min(effective_n_jobs(args.n_jobs), len(images_norm)))
+            features = (Parallel(n_jobs=args.n_jobs)(delayed(MRELBP_batch)  # Initialize
+                        (np.stack([images_norm[i] for i in chunk]), parameters,  # LBP parameters
+                         normalize=args.normalize_hist,
+                         median_method=args.median_method,
+                         median_threads=threads)
+                          for chunk in tqdm(chunks, desc='Calculating LBP features')))  # Iterable
+            features = np.concatenate(features, axis=0)
+        elif args.convolution:
             features = (Parallel(n_jobs=args.n_jobs)(delayed(Conv_MRELBP)  # Initialize
                         (images_norm[i], parameters,  # LBP parameters
                          normalize=args.normalize_hist,
+                         median_method=args.median_method,
                          savepath=args.save_path + '/Images/LBP/',
                          sample=files_input[i][:-3] + '_' + grade_used)  # Save paths
                           for i in tqdm(range(len(files_input)), desc='Calculating LBP features')))  # Iterable
@@ -77,6 +104,8 @@ def pipeline_lbp(args, files, parameters, grade_used):
             features = (Parallel(n_jobs=args.n_jobs)(delayed(MRELBP)  # Initialize
                         (images_norm[i], parameters,  # LBP parameters
                          normalize=args.normalize_hist,
+                         median_method=args.median_method,
+                         median_threads=threads,
                          args=args,
                          sample=files_input[i][:-3] + '_' + grade_used)  # Save paths
                           for i in tqdm(range(len(files_input)), desc='Calculating LBP features')))  # Iterable
@@ -96,6 +125,64 @@ def pipeline_lbp(args, files, parameters, grade_used):
     print('Elapsed time: {0}s'.format(t))
 
 
+def pipeline_lbp_subimages(args, files, parameters, grade_used):
+    """Calculates LBP features for subimages of full input images (mean + standard deviation).
+
+    Subimage features are obtained from integral histograms of the full image LBP images (see MRELBP_windows),
+    so normalization and MRELBP are calculated only once per sample. Subimages follow create_subimages
+    and the features are saved as in pipeline_lbp for subvolume images (sample_sub<index>).
+    Automatic cropping is not used, since subimage locations refer to the uncropped image.
+
+    Parameters
+    ----------
+    args : Namespace
+        Grading arguments. See pipeline_lbp. In addition:
+        n_subvolumes = Amount of subimages (subvolumes_x * subvolumes_y).
+        subvolumes_x = Number of subimages along the first image axis.
+        subvolumes_y = Number of subimages along the second image axis.
+        subimage_size = Width and height of the subimages.
+    files : list
+        List of full input image datasets (as .h5)
+    parameters : dict
+        MRELBP parameters used. See MRELBP and local_standard
+    grade_used : str
+        Name of the grade that is used. Features are saved with this name.
+    """
+    if args.subvolumes_x * args.subvolumes_y != args.n_subvolumes:
+        raise Exception('Number of subvolumes does not match the subimage grid!')
+    start_time = time()
+
+    # Calculate features, shape (n_files, n_subvolumes, 32)
+    threads = worker_threads(args, min(effective_n_jobs(args.n_jobs), len(files)))
+    features = np.array(Parallel(n_jobs=args.n_jobs)(delayed(subimage_features)(args, file, grade_used, parameters,
+                                                                                 median_threads=threads)
+                                                      for file in tqdm(files, desc='Calculating LBP features')))
+
+    # Save features
+    if args.train_regression:
+        names = [file[:-3] + '_sub' + str(vol) + '.h5' for file in files for vol in range(args.n_subvolumes)]
+        save_excel(features.reshape(-1, features.shape[-1]).T, args.save_path + '/Features/' + grade_used + '.xlsx',
+                   names)
+    else:
+        for vol in range(args.n_subvolumes):
+            names = [file[:-3] + '_sub' + str(vol) + '.h5' for file in files]
+            save_excel(features[:, vol].T, args.save_path + '/Features/' + grade_used + '_' + str(vol) + '.xlsx',
+                       names)
+
+    # Display spent time
+    t = time() - start_time
+    print('Elapsed time: {0}s'.format(t))
+
+
+def subimage_features(args, file, grade, par, median_threads=1):
+    """Loads mean+std image and calculates MRELBP features for the subimage grid."""
+    image = load_voi(args, file, grade, par, autocrop=False)
+    windows = subimage_windows(image.shape, n_x=args.subvolumes_x, n_y=args.subvolumes_y,
+                               im_size_x=args.subimage_size, im_size_y=args.subimage_size)
+    return MRELBP_windows(image, par, windows, normalize=args.normalize_hist, median_method=args.median_method,
+                          median_threads=median_threads)
+
+
 def pipeline_prediction(args, grade_name, pat_groups=None, check_samples=False, combiner=np.mean):
     """Gets predictions from saved MRELBP features.
 
@@ -119,6 +206,7 @@ def pipeline_prediction(args, grade_name, pat_groups=None, check_samples=False,
         save_path = Path to save results.
         train_regression = Choice whether to train a new model or evaluate on an existing one.
         standardization = Choice whether to center features before PCA.
+        pca_solver = PCA solver. With incremental, PCA is fitted to the features in batches of pca_batch_size.
         split = Cross-validation split used in training the model.
         logistic_limit = Limit used to make logistic prediction.
         convert_grades = Choice whether to predict optionally exp or log of grades.
@@ -202,9 +290,21 @@ def pipeline_prediction(args, grade_name, pat_groups=None, check_samples=False,
         else:
             features = standardize(features.T, axis=0)
 
+        # Loss surface for choosing alpha and number of PCA components
+        if args.sweep_regression:
+            components = [k for k in args.sweep_components if k <= min(features.shape)]
+            surface = regression_sweep(features, grades, args.sweep_alphas, components, groups=pat_groups,
+                                       convert=args.convert_grades)
+            k, alpha = np.unravel_index(np.argmin(surface.values), surface.shape)
+            print('Regression loss surface (n_components x alpha):\n', surface)
+            print('Minimum loss {0} with n_components = {1}, alpha = {2}'
+                  .format(surface.values[k, alpha], surface.index[k], surface.columns[alpha]))
+            surface.to_excel(args.save_path + '/sweep_' + grade_name + '.xlsx')
+
         # PCA
         if args.use_PCA:
-            pca, score = scikit_pca(features, args.n_components, whitening=True, solver='auto')
+            pca, score = scikit_pca(features, args.n_components, whitening=True, solver=args.pca_solver,
+                                    batch_size=args.pca_batch_size)
             eigenvectors = pca.components_
             singular_values = pca.singular_values_ / np.sqrt(features.shape[1] - 1)
         else:
@@ -216,14 +316,17 @@ def pipeline_prediction(args, grade_name, pat_groups=None, check_samples=False,
         pred_linear, weights, intercept_lin = lin_regressor(score, grades, groups=pat_groups, alpha=args.alpha,
                                                             method=args.regression, convert=args.convert_grades)
         if args.binary_model == 'LOG':
-            pred_logistic, weights_log, intercept_log = log_regressor(score, grades > bound, groups=pat_groups)
+            pred_logistic, weights_log, intercept_log = log_regressor(score, grades > bound, groups=pat_groups,
+                                                                      n_jobs=args.n_jobs)
         elif args.binary_model == 'RF':
             pred_logistic, weights_log, intercept_log = rforest_logo(score, grades > bound, groups=pat_groups,
                                                                      #savepath=args.save_path, zone=grade_name)
                                                                      zone=grade_name)
 
-        pca_regress_pipeline_log(features, grades, pat_groups, n_components=args.n_components, grade_name=grade_name,
-                                 savepath=f'{args.save_path}/Shap_')
+        # SHAP values are calculated in the background and plotted after the results
+        explanation = pca_regress_pipeline_log(features, grades, pat_groups, n_components=args.n_components,
+                                               grade_name=grade_name, savepath=f'{args.save_path}/Shap_',
+                                               n_jobs=args.n_jobs, deferred=args.deferred_shap)
 
         # Save calculated weights
         print(f'Intercepts: {intercept_log}, {intercept_lin}')
@@ -264,24 +367,17 @@ def pipeline_prediction(args, grade_name, pat_groups=None, check_samples=False,
 
     else:
         print('\nEvaluating with saved model weights on: {0}\n'.format(grade_name))
+        explanation = None
         model_root = os.path.dirname(args.save_path)
         if args.n_subvolumes > 1:
-            preds_lin, preds_log, scores = [], [], []
-            for vol in range(args.n_subvolumes):
-                pred_linear_sub, pred_logistic_sub, score_sub = evaluate_model(feature_list[vol], args,
-                                                                               model_root + '/' + grade_name + '_weights.dat')
-                preds_lin.append(pred_linear_sub)
-                preds_log.append(pred_logistic_sub)
-                scores.append(score_sub)
-
-            pred_linear = combiner(np.array(preds_lin), axis=0)
-            pred_logistic = combiner(np.array(preds_log), axis=0)
-            score = combiner(np.array(scores), axis=0)
+            # Predict all subvolumes at once
+            model = compiled_model(model_root + '/' + grade_name + '_weights.dat', args)
+            subvolume_index = np.concatenate([np.full(f.shape[1], vol) for vol, f in enumerate(feature_list)])
+            pred_linear, pred_logistic, score = model.predict_batch(np.concatenate(feature_list, axis=1),
+                                                                    subvolume_index, combiner=combiner)
         else:
             pred_linear, pred_logistic, score = evaluate_model(features, args, model_root + '/' + grade_name + '_weights.dat')
 
-
-
     # Reference for pretrained PCA
     # reference_regress(features, args, score, grade_name + '_weights.dat', pred_linear, pred_logistic)
 
@@ -335,6 +431,10 @@ def pipeline_prediction(args, grade_name, pat_groups=None, check_samples=False,
     #plot_linear(grades, pred_linear, text_string=text_string, plt_title=grade_name, savepath=save_lin)
     plot_linear(grades, pred_linear, text_string=None, plt_title=grade_name, savepath=save_lin)
 
+    # SHAP summary plots
+    if explanation is not None:
+        summary_plots(*explanation.result(), features, grade_name=grade_name, savepath=f'{args.save_path}/Shap_')
+
     """
     # Plot PCA components
     save_pca = args.save_path + '/pca_' + grade_name + '_' + args.split
@@ -401,9 +501,9 @@ def load_voi(args, file, grade, par, save_images=False, autocrop=True):
 
     # Median filtering for noisy images
     if args.median_filter:
-        image = medfilt2d(image, 3)
+        image = median_filter(image, 3, method=args.median_method)
     # Normalize
-    image_norm = local_standard(image, par)
+    image_norm = local_standard(image, par, method=args.normalization)
     # Save image
     if save_images:
         titles_norm = ['Mean + Std', '', 'Normalized']
@@ -0,0 +1,137 @@
+"""Contains SHAP contributions of the linear and logistic grading models and their summary plots."""
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Names of the MRELBP features (zero features removed)
+feature_names = ['Center +', 'Center -', 'Large U-1', 'Large U-2', 'Large U-3', 'Large U-4', 'Large U-5', 'Large U-6',
+                 'Large U-7', 'Large N-U', 'Small U-1', 'Small U-2', 'Small U-3', 'Small U-4', 'Small U-5', 'Small U-6',
+                 'Small U-7', 'Small N-U', 'Radial U-0', 'Radial U-1', 'Radial U-2', 'Radial U-3', 'Radial U-4',
+                 'Radial U-5', 'Radial U-6', 'Radial U-7', 'Radial U-8', 'Radial N-U']
+
+# Single background worker, so that explanations are computed in submission order
+_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def linear_shap(coefs, means, features, folds):
+    """Calculates SHAP values of linear models for all samples in one matrix operation.
+
+    For a linear model f(x) = w x + b, the SHAP value of feature j is w_j (x_j - E[x_j]), where the expectation is
+    taken over the training data (background). For logistic regression the values explain the log-odds.
+    This equals shap.LinearExplainer with independent features. The values of a sample sum to f(x) - E[f(x)].
+
+    Parameters
+    ----------
+    coefs : ndarray
+        Model coefficients of each split (splits x features).
+    means : ndarray
+        Training data mean of each split (splits x features).
+    features : ndarray
+        Test samples of all splits (samples x features).
+    folds : ndarray
+        Split index of each test sample.
+    Returns
+    -------
+    SHAP values (samples x features).
+    """
+    coefs = np.asarray(coefs).reshape(len(means), -1)
+    folds = np.asarray(folds)
+    return coefs[folds] * (features - means[folds])
+
+
+def shap_logo(features, splits, coefs):
+    """Calculates cross-validated SHAP values of linear models.
+
+    Centering features by the mean of training split does not change the values, since it cancels out.
+
+    Parameters
+    ----------
+    features : ndarray
+        Features used in the models (samples x features).
+    splits : list
+        Train and test indices of each split.
+    coefs : ndarray
+        Model coefficients of each split.
+    Returns
+    -------
+    SHAP values of the test samples, concatenated in the order of splits.
+    """
+    means = np.array([features[train_idx].mean(0) for train_idx, _ in splits])
+    x_test = np.concatenate([features[test_idx] for _, test_idx in splits])
+    folds = np.concatenate([np.full(len(test_idx), k) for k, (_, test_idx) in enumerate(splits)])
+    return linear_shap(coefs, means, x_test, folds)
+
+
+def explain_logo(features, splits, coefs, coefs_lin, pca):
+    """Calculates cross-validated SHAP values of PCA + logistic and linear regression models.
+
+    PCA is merged into the model weights of the input features, w / sqrt(explained variance) @ components
+    for whitened PCA, and the values are calculated for the input features of the merged model.
+
+    Parameters
+    ----------
+    features : ndarray
+        Input features (samples x features).
+    splits : list
+        Train and test indices of each split.
+    coefs : ndarray
+        Logistic regression coefficients of the PCA components in each split.
+    coefs_lin : ndarray
+        Linear regression coefficients of the PCA components in each split.
+    pca : sklearn.decomposition.PCA
+        PCA fitted to the features.
+    Returns
+    -------
+    SHAP values of logistic and linear regression models (samples x features).
+    """
+    # Weights of the input features for each PCA component
+    weights = pca.components_
+    if pca.whiten:
+        weights = weights / np.sqrt(pca.explained_variance_)[:, None]
+
+    coefs = np.reshape(coefs, (len(splits), -1)) @ weights
+    coefs_lin = np.reshape(coefs_lin, (len(splits), -1)) @ weights
+    return shap_logo(features, splits, coefs), shap_logo(features, splits, coefs_lin)
+
+
+def submit(function, *args, **kwargs):
+    """Runs function in the background worker and returns a concurrent.futures.Future of the result."""
+    return _executor.submit(function, *args, **kwargs)
+
+
+def summary_plots(shap_values, shap_values_lin, features, grade_name='', savepath=None):
+    """Draws SHAP summary plots of logistic and linear regression models.
+
+    Parameters
+    ----------
+    shap_values : ndarray
+        SHAP values of the logistic regression model.
+    shap_values_lin : ndarray
+        SHAP values of the linear regression model.
+    features : ndarray
+        Feature values shown in the plots.
+    grade_name : str
+        Title of the predicted grade.
+    savepath : str
+        Path prefix for saving the plots. If None, plots are only displayed.
+    """
+    import shap  # Only needed for plotting
+
+    # Summary plots
+    shap.summary_plot(shap_values, features, show=False, feature_names=feature_names)
+    # plt.title(f'Logistic Regression ({grade_name})')
+    if savepath is not None:
+        plt.savefig(f'{savepath}{grade_name}_logistic_cov.png', transparent=False, bbox_inches='tight')
+        plt.show()
+    else:
+        plt.show()
+    shap.summary_plot(shap_values_lin, features, show=False, feature_names=feature_names)
+    # plt.title(f'Linear Ridge Regression ({grade_name})')
+    if savepath is not None:
+        plt.savefig(f'{savepath}{grade_name}_linear_cov.png', transparent=False, bbox_inches='tight')
+        plt.show()
+    else:
+        plt.show()
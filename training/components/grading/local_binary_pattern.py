@@ -2,12 +2,83 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-
-from scipy.signal import medfilt2d
-from scipy.ndimage import convolve, correlate
+import cv2
+
+from collections import OrderedDict
+from functools import partial, wraps
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from scipy.signal import medfilt2d, lfilter, lfilter_zi
+from scipy.ndimage import convolve, correlate, convolve1d, correlate1d
 from components.utilities.load_write import load_excel
 from components.utilities.misc import print_images
 
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, MRELBP_fused falls back to NumPy
+    njit = None
+
+
+class KernelCache(object):
+    """Bounded least recently used cache for kernels and mapping tables.
+
+    Cached arrays (or tuples of arrays) are set read-only,
+    since the same arrays are returned for every call with equal arguments.
+    Hits and misses are counted for monitoring the setup overhead in parameter optimization.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of cached arrays.
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, factory):
+        """Returns cached array for key, or creates it by calling factory()."""
+        with self._lock:
+            if key in self._arrays:
+                self.hits += 1
+                self._arrays.move_to_end(key)
+                return self._arrays[key]
+            self.misses += 1
+        array = factory()
+        for a in (array if isinstance(array, tuple) else (array,)):
+            a.setflags(write=False)
+        with self._lock:
+            self._arrays[key] = array
+            while len(self._arrays) > self.maxsize:
+                self._arrays.popitem(last=False)
+        return array
+
+    def info(self):
+        """Returns dictionary with cache hits, misses, current size and maximum size."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._arrays), 'maxsize': self.maxsize}
+
+    def clear(self):
+        """Empties the cache and resets counters."""
+        with self._lock:
+            self._arrays.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Shared by all kernel and mapping factories of the module
+kernel_cache = KernelCache()
+
+
+def cached_kernel(function):
+    """Decorator storing the output of a kernel factory in kernel_cache, keyed by function name and arguments."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        key = (function.__name__,) + args + tuple(sorted(kwargs.items()))
+        return kernel_cache.get(key, lambda: function(*args, **kwargs))
+    return wrapper
+
 
 def image_bilinear(im, col, x, row, y, eps=1e-12):
     """Calculates bilinear interpolation from image.
@@ -46,7 +117,8 @@ def image_bilinear(im, col, x, row, y, eps=1e-12):
     return p
 
 
-def MRELBP(image, parameters, eps=1e-06, normalize=False, args=None, sample=None):
+def MRELBP(image, parameters, eps=1e-06, normalize=False, args=None, sample=None, median_method='scipy',
+           median_threads=1):
     """ Takes Median Robust Extended Local Binary Pattern from image im
     Uses n neighbours from radii r_large and r_small, r_large must be larger than r_small
     Median filter uses kernel sizes weight_center for center pixels, w_r[0] for larger radius and w_r[1]
@@ -73,19 +145,456 @@ def MRELBP(image, parameters, eps=1e-06, normalize=False, args=None, sample=None
         Path for saving LBP images.
     sample : str
         Name of the sample used in saving images.
+    median_method : str
+        Median filtering engine. See median_filter.
+    median_threads : int
+        Number of threads used by exact median filtering. See median_filter.
     Returns
     -------
     MRELBP histograms calculated with rotation invariant uniform mapping.
     Length of 32 (2 center + 10 large + 10 small + 10 radial).
     """
+    n = parameters['N']
+
+    # LBP images and histograms
+    hists, lbp_images, image_center = _mrelbp_core(image, parameters, eps=eps,
+                                                   median=partial(median_filter, method=median_method,
+                                                                  n_threads=median_threads))
+    lbp_large, lbp_small, lbp_radial = lbp_images
+
+    # Concatenate histograms
+    hist = np.concatenate(hists, 1)
+
+    if normalize:
+        hist /= np.sum(hist)
+
+    if args is not None and args.save_images and sample is not None \
+            and (('21_L3L' in sample) or ('20_R2M' in sample)):
+
+        # Map LBP images
+        mapping = get_mapping(n)
+        lbp_large_mapped = map_lbp(lbp_large, mapping)
+        lbp_small_mapped = map_lbp(lbp_small, mapping)
+        lbp_radial_mapped = map_lbp(lbp_radial, mapping)
+        lbp_list = [lbp_large_mapped, lbp_small_mapped, lbp_radial_mapped]
+
+        # Load coefficients
+        coefs, _ = load_excel(args.save_path + '/' + 'weights_surf_sub.xlsx' , titles=['Weights_lin', 'Weights_log'])
+        thresh = 0.1
+        lin = coefs[0]
+        log = coefs[1]
+        lin = np.abs(np.insert(lin, [2, 9, 10, 17], 0)) > thresh
+        log = np.abs(np.insert(log, [2, 9, 10, 17], 0)) > thresh
+
+        masks = [np.zeros(lbp_large.shape), np.zeros(lbp_large.shape), np.zeros(lbp_large.shape)]
+
+        for mask in range(len(masks)):
+            for ind in range(int(np.max(lbp_large_mapped)) + 1):
+                masks[mask] += (ind + 1) * (lbp_list[mask] == ind) * log[2+mask*10:2+(mask+1)*10][ind]
+
+        # No instances in LBP_large (0,8) and LBP_small (0,8)
+        print_images(lbp_list, subtitles=['Large', 'Small', 'Radial'], title=sample,
+                     sample=sample + '.png')
+
+        # Print center image
+        fig = plt.figure(dpi=300)
+        ax = fig.add_subplot(111)
+        ax.imshow(image_center >= 0)
+        plt.title('Center')
+        plt.savefig(args.save_path + '/Images/LBP/' + sample + '_center.png', transparent=True)
+        plt.close()
+
+        # Print unmapped LBP
+        #print_images([lbp_large, lbp_small, lbp_radial], subtitles=['Large', 'Small', 'Radial'], title=sample,
+        #             save_path=args.save_path + '/Images/LBP/', sample=sample + '.png')
+
+    return hist
+
+
+def MRELBP_batch(images, parameters, eps=1e-06, normalize=False, median_method='scipy', median_threads=1):
+    """Calculates MRELBP features for a stack of images with equal shape.
+
+    Neighbour and LBP buffers are allocated once and reused for every image in the stack.
+    Features are identical to calling MRELBP separately for each image.
+
+    Parameters
+    ----------
+    images : ndarray or list
+        Stack of normalized input images with shape (n_images, height, width).
+    parameters : dict
+        MRELBP parameters. See MRELBP.
+    eps : float
+        Error residual. Defaults to 1e-6
+    normalize : bool
+        Choice whether to normalize LBP histograms by sum.
+    median_method : str
+        Median filtering engine. See median_filter.
+    median_threads : int
+        Number of threads used by exact median filtering. See median_filter.
+    Returns
+    -------
+    MRELBP features with shape (n_images, 32).
+    """
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[None]
+
+    workspace = _mrelbp_workspace(images.shape[1:], parameters)
+    n_bins = 2 + 3 * (int(_riu2_table(parameters['N']).max()) + 1)
+    features = np.zeros((images.shape[0], n_bins))
+    for i in range(images.shape[0]):
+        hists, _, _ = _mrelbp_core(images[i], parameters, eps=eps, workspace=workspace,
+                                   median=partial(median_filter, method=median_method, n_threads=median_threads))
+        features[i] = np.concatenate(hists, 1)
+
+    if normalize:
+        features /= features.sum(axis=1, keepdims=True)
+
+    return features
+
+
+def MRELBP_multi(image, parameter_list, eps=1e-06, normalize=False, method='direct', median_method='scipy',
+                 median_threads=1):
+    """Calculates MRELBP features of one image for multiple parameter sets.
+
+    Local normalization, image scaling and median filtering are memoized per image,
+    so that parameter sets sharing normalization kernels or median kernel sizes reuse the same intermediates.
+    Features are identical to calling local_normalize_abs and MRELBP separately for each parameter set.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image (mean + std) before local normalization.
+    parameter_list : list
+        List of parameter dictionaries. Each should contain the keys used in local_normalize_abs and MRELBP.
+    eps : float
+        Error residual. Defaults to 1e-6
+    normalize : bool
+        Choice whether to normalize LBP histograms by sum.
+    method : str
+        Filtering backend used in local normalization. See local_normalize_abs.
+    median_method : str
+        Median filtering engine. See median_filter.
+    median_threads : int
+        Number of threads used by exact median filtering. See median_filter.
+    Returns
+    -------
+    MRELBP features with shape (n_parameter_sets, 32).
+    """
+    # Group parameter sets by normalization kernels, so that only one normalized image is kept in memory
+    keys = [(p['ks1'], p['sigma1'], p['ks2'], p['sigma2']) for p in parameter_list]
+    order = sorted(range(len(parameter_list)), key=lambda i: keys[i])
+
+    features = [None] * len(parameter_list)
+    key_norm, image_norm, medians = None, None, dict()
+    for i in order:
+        parameters = parameter_list[i]
+        # Local normalization
+        if keys[i] != key_norm:
+            key_norm = keys[i]
+            image_norm = local_normalize_abs(image, parameters, method=method)
+            medians = dict()
+
+        def median(image_scaled, kernel):
+            if kernel not in medians:
+                medians[kernel] = median_filter(image_scaled, kernel, method=median_method, n_threads=median_threads)
+            return medians[kernel]
+
+        hists, _, _ = _mrelbp_core(image_norm, parameters, eps=eps, median=median)
+        features[i] = np.concatenate(hists, 1)
+    features = np.concatenate(features, 0)
+
+    if normalize:
+        features /= features.sum(axis=1, keepdims=True)
+
+    return features
+
+
+def MRELBP_fused(image, parameters, eps=1e-06, normalize=False, median_method='scipy', median_threads=1):
+    """Calculates MRELBP features with a compiled kernel that fuses sampling, thresholding and binning.
+
+    Image scaling and median filtering are done as in MRELBP. After that, each pixel is processed in one pass:
+    neighbours are interpolated, thresholded against the neighbourhood mean and the riu2 histograms are incremented
+    without storing neighbour or LBP images. Requires Numba, falls back to the NumPy implementation (_mrelbp_core)
+    if Numba is not installed.
+
+    Interpolation and neighbourhood sums use the same operation order as the NumPy implementation,
+    so histograms are expected to match MRELBP exactly. Tolerance: counts may differ only for pixels where
+    a neighbour lies within floating point rounding (~1e-15 relative) of its threshold.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image. Standardized to local contrast in the pipelines.
+    parameters : dict
+        MRELBP parameters. See MRELBP.
+    eps : float
+        Error residual. Defaults to 1e-6
+    normalize : bool
+        Choice whether to normalize LBP histograms by sum.
+    median_method : str
+        Median filtering engine. See median_filter.
+    median_threads : int
+        Number of threads used by exact median filtering. See median_filter.
+    Returns
+    -------
+    MRELBP histogram with shape (1, 32).
+    """
+    if njit is None:
+        hists, _, _ = _mrelbp_core(image, parameters, eps=eps,
+                                   median=partial(median_filter, method=median_method, n_threads=median_threads))
+        hist = np.concatenate(hists, 1)
+        if normalize:
+            hist /= np.sum(hist)
+        return hist
 
     n = parameters['N']
     r_large = parameters['R']
     r_small = parameters['r']
+
+    # Centering and scaling with std
+    image_scaled = (image - image.mean()) / image.std()
+
+    # Median filtered images
+    image_center = median_filter(image_scaled, parameters['wc'], method=median_method,
+                                 n_threads=median_threads)
+    image_large = median_filter(image_scaled, parameters['wl'], method=median_method,
+                                n_threads=median_threads)
+    image_small = median_filter(image_scaled, parameters['ws'], method=median_method,
+                                n_threads=median_threads)
+
+    # Center pixels
+    dist = round(r_large + (parameters['wl'] - 1) / 2)
+    image_center = image_center[dist:-dist, dist:-dist]
+    center_mean = image_center.mean()
+
+    # Neighbour locations and interpolation weights
+    offsets_large, weights_large = neighbour_taps(r_large, n, dist, eps=eps)
+    offsets_small, weights_small = neighbour_taps(r_small, n, dist, eps=eps)
+
+    hist = _mrelbp_fused_kernel(np.ascontiguousarray(image_center), center_mean, image_large, image_small,
+                                offsets_large, weights_large, offsets_small, weights_small,
+                                _riu2_table(n).astype(np.intp), n)
+    hist = hist.reshape(1, -1).astype(np.float64)
+
+    if normalize:
+        hist /= np.sum(hist)
+
+    return hist
+
+
+def MRELBP_windows(image, parameters, windows, eps=1e-06, normalize=False, median_method='scipy', median_threads=1):
+    """Calculates MRELBP features for multiple windows of one image using integral histograms.
+
+    LBP images are calculated once for the full image and mapped with riu2 mapping.
+    Integral histograms of the mapped images give the large, small and radial histograms of any window
+    with four lookups per bin. Center histograms are counted exactly per window, thresholded at the window mean.
+
+    Window features are calculated as if the window was cropped before MRELBP: a window of shape (h, w)
+    gives histograms of (h - 2 * dist) * (w - 2 * dist) pixels, where dist = round(R + (wl - 1) / 2).
+    Compared to cropping the window first, pixels near the window border use image context outside the window
+    in median filtering and interpolation instead of zero padding, so histograms can differ slightly at the borders.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image. Standardized to local contrast in the pipelines.
+    parameters : dict
+        MRELBP parameters. See MRELBP.
+    windows : list
+        Windows (row_start, row_stop, column_start, column_stop) in image coordinates. See subimage_windows.
+    eps : float
+        Error residual. Defaults to 1e-6
+    normalize : bool
+        Choice whether to normalize LBP histograms by sum.
+    median_method : str
+        Median filtering engine. See median_filter.
+    median_threads : int
+        Number of threads used by exact median filtering. See median_filter.
+    Returns
+    -------
+    MRELBP features with shape (n_windows, 32).
+    """
+    n = parameters['N']
+    dist = round(parameters['R'] + (parameters['wl'] - 1) / 2)
+
+    # LBP images of the full image
+    _, lbp_images, image_center = _mrelbp_core(image, parameters, eps=eps,
+                                               median=partial(median_filter, method=median_method,
+                                                              n_threads=median_threads))
+    table = _riu2_table(n)
+    n_bins = int(table.max()) + 1
+    integrals = [integral_histogram(table[lbp], n_bins) for lbp in lbp_images]
+
+    features = np.zeros((len(windows), 2 + 3 * n_bins))
+    for i, (y0, y1, x0, x1) in enumerate(windows):
+        # Window in LBP image coordinates
+        y1, x1 = y1 - 2 * dist, x1 - 2 * dist
+        if y1 <= y0 or x1 <= x0 or y0 < 0 or x0 < 0:
+            raise Exception('Window ({0}, {1}, {2}, {3}) does not fit MRELBP with border {4}.'
+                            .format(y0, y1 + 2 * dist, x0, x1 + 2 * dist, dist))
+
+        # Center pixels
+        center = image_center[y0:y1, x0:x1]
+        center = center - center.mean()
+        features[i, 0] = np.sum(center >= 0)
+        features[i, 1] = np.sum(center < 0)
+
+        # Large, small and radial histograms
+        for j, integral in enumerate(integrals):
+            features[i, 2 + j * n_bins:2 + (j + 1) * n_bins] = window_histogram(integral, y0, y1, x0, x1)
+
+    if normalize:
+        features /= features.sum(axis=1, keepdims=True)
+
+    return features
+
+
+def integral_histogram(mapped, n_bins):
+    """Calculates integral histogram of a mapped LBP image.
+
+    Parameters
+    ----------
+    mapped : ndarray
+        LBP image with integer bin indices (e.g. riu2 mapped codes).
+    n_bins : int
+        Number of histogram bins.
+    Returns
+    -------
+    Cumulative bin counts with shape (row + 1, col + 1, n_bins). See window_histogram.
+    """
+    integral = np.zeros((mapped.shape[0] + 1, mapped.shape[1] + 1, n_bins), dtype=np.int32)
+    for b in range(n_bins):
+        np.cumsum(np.cumsum(mapped == b, axis=0, dtype=np.int32), axis=1, out=integral[1:, 1:, b])
+    return integral
+
+
+def window_histogram(integral, y0, y1, x0, x1):
+    """Returns histogram of window [y0:y1, x0:x1] from an integral histogram."""
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def _mrelbp_fused_pass(image_center, center_mean, image_large, image_small,
+                       offsets_large, weights_large, offsets_small, weights_small, table, n):
+    """Single pass over the center pixels. Compiled with Numba as _mrelbp_fused_kernel.
+
+    Returns concatenated histogram counts (center, large, small, radial).
+    """
+    row, col = image_center.shape
+    n_bins = table.max() + 1
+    hist = np.zeros(2 + 3 * n_bins, dtype=np.int64)
+    p_large = np.empty(n)
+    p_small = np.empty(n)
+    partials = np.empty(8)
+    means = np.zeros(2)
+
+    for i in range(row):
+        for j in range(col):
+            # Center pixel
+            if image_center[i, j] - center_mean >= 0:
+                hist[0] += 1
+            else:
+                hist[1] += 1
+
+            # Bilinear interpolation, same operations as in sample_neighbour
+            for k in range(n):
+                q11 = image_large[i + offsets_large[k, 0, 0], j + offsets_large[k, 0, 1]]
+                q21 = image_large[i + offsets_large[k, 1, 0], j + offsets_large[k, 1, 1]]
+                q12 = image_large[i + offsets_large[k, 2, 0], j + offsets_large[k, 2, 1]]
+                q22 = image_large[i + offsets_large[k, 3, 0], j + offsets_large[k, 3, 1]]
+                p_large[k] = weights_large[k, 2] * (weights_large[k, 0] * q11 + weights_large[k, 1] * q21) + \
+                    weights_large[k, 3] * (weights_large[k, 0] * q12 + weights_large[k, 1] * q22)
+                q11 = image_small[i + offsets_small[k, 0, 0], j + offsets_small[k, 0, 1]]
+                q21 = image_small[i + offsets_small[k, 1, 0], j + offsets_small[k, 1, 1]]
+                q12 = image_small[i + offsets_small[k, 2, 0], j + offsets_small[k, 2, 1]]
+                q22 = image_small[i + offsets_small[k, 3, 0], j + offsets_small[k, 3, 1]]
+                p_small[k] = weights_small[k, 2] * (weights_small[k, 0] * q11 + weights_small[k, 1] * q21) + \
+                    weights_small[k, 3] * (weights_small[k, 0] * q12 + weights_small[k, 1] * q22)
+
+            # Neighbourhood means, same summation order as _neighbour_sum
+            for m in range(2):
+                p = p_large if m == 0 else p_small
+                if n < 8 or n > 128:
+                    total = 0.0
+                    for k in range(n):
+                        total += p[k]
+                else:
+                    for jj in range(8):
+                        partials[jj] = p[jj]
+                        for ii in range(8, n - n % 8, 8):
+                            partials[jj] += p[ii + jj]
+                    total = ((partials[0] + partials[1]) + (partials[2] + partials[3])) + \
+                            ((partials[4] + partials[5]) + (partials[6] + partials[7]))
+                    for k in range(n - n % 8, n):
+                        total += p[k]
+                means[m] = total / n
+
+            # Codes
+            code_large = 0
+            code_small = 0
+            code_radial = 0
+            for k in range(n):
+                if p_large[k] >= means[0]:
+                    code_large |= 1 << k
+                if p_small[k] >= means[1]:
+                    code_small |= 1 << k
+                if p_large[k] >= p_small[k]:
+                    code_radial |= 1 << k
+
+            # Rotation invariant uniform histograms
+            hist[2 + table[code_large]] += 1
+            hist[2 + n_bins + table[code_small]] += 1
+            hist[2 + 2 * n_bins + table[code_radial]] += 1
+
+    return hist
+
+
+_mrelbp_fused_kernel = njit(cache=True, nogil=True)(_mrelbp_fused_pass) if njit is not None else None
+
+
+def _mrelbp_workspace(shape, parameters):
+    """Allocates mean and LBP image buffers for MRELBP on images with given shape."""
+    n = parameters['N']
+    dist = round(parameters['R'] + (parameters['wl'] - 1) / 2)
+    row, col = shape[0] - 2 * dist, shape[1] - 2 * dist
+    workspace = dict()
+    for key in ['lbp_large', 'lbp_small', 'lbp_radial']:
+        workspace[key] = np.zeros((row, col), dtype=_code_dtype(n))
+    return workspace
+
+
+def _mrelbp_core(image, parameters, eps=1e-06, workspace=None, median=None):
+    """Calculates MRELBP images and unnormalized histograms from a single image.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image. Standardized to local contrast in the pipelines.
+    parameters : dict
+        MRELBP parameters. See MRELBP.
+    eps : float
+        Error residual. Defaults to 1e-6
+    workspace : dict
+        Preallocated buffers from _mrelbp_workspace. Allocated for the image if not given.
+    median : function
+        Median filter called as median(image_scaled, kernel_size). Filtered images are not modified.
+        Defaults to exact median_filter.
+    Returns
+    -------
+    Histograms (center, large, small, radial), integer LBP images (large, small, radial) and centered center image.
+    """
+    n = parameters['N']
+    r_large = parameters['R']
+    r_small = parameters['r']
     weight_center = parameters['wc']
     weight_large = parameters['wl']
     weight_small = parameters['ws']
 
+    if workspace is None:
+        workspace = _mrelbp_workspace(image.shape, parameters)
+    if median is None:
+        median = median_filter
+
     # Mean grayscale value and std
     mean_image = image.mean()
     std_image = image.std()
@@ -94,10 +603,10 @@ def MRELBP(image, parameters, eps=1e-06, normalize=False, args=None, sample=None
     image_scaled = (image - mean_image) / std_image
 
     # Median filtering
-    image_center = medfilt2d(image_scaled.copy(), weight_center)
+    image_center = median(image_scaled, weight_center)
     # Center pixels
     dist = round(r_large + (weight_large - 1) / 2)
-    image_center = image_center[dist:-dist, dist:-dist]
+    image_center = image_center[dist:-dist, dist:-dist].copy()
     # Subtracting the mean pixel value from center pixels
     image_center -= image_center.mean()
     # Binning center pixels
@@ -109,138 +618,204 @@ def MRELBP(image, parameters, eps=1e-06, normalize=False, args=None, sample=None
     # center_hist[0,0] = np.sum(image_center>=-1e-06)
     # center_hist[0,1] = np.sum(image_center<-1e-06)
     # --------------- #
-    
-    # Median filtered images for large and small radius
-    image_large = medfilt2d(image_scaled.copy(), weight_large)
-    image_small = medfilt2d(image_scaled.copy(), weight_small)
-
-    # Neighbours
-    pi = np.pi
-    # Empty arrays for the neighbours
-    row, col = np.shape(image_center)
-    n_large = np.zeros((row, col, n))
-    n_small = np.zeros((row, col, n))
-    
-    for k in range(n):
-        # Angle to the neighbour
-        theta = k * (-1 * 2 * pi / n)
-        # Large neighbourhood
-        x = dist + r_large * np.cos(theta)
-        y = dist + r_large * np.sin(theta)
-        if abs(x - round(x)) < eps and abs(y - round(y)) < eps:
-            x = int(round(x))
-            y = int(round(y))
-            p = image_large[y:y + row, x:x + col]
-        else:
-            p = image_bilinear(image_large, col, x, row, y)
-        n_large[:, :, k] = p
-        # Small neighbourhood
-        x = dist + r_small * np.cos(theta)
-        y = dist + r_small * np.sin(theta)
-        if abs(x-round(x)) < eps and abs(y-round(y)) < eps:
-            x = int(round(x))
-            y = int(round(y))
-            p = image_small[y:y + row, x:x + col]
-        else:
-            p = image_bilinear(image_small, col, x, row, y)
-        n_small[:, :, k] = p
 
-    # Thresholding radial neighbourhood
-    n_radial = n_large - n_small
+    # Median filtered images for large and small radius
+    image_large = median(image_scaled, weight_large)
+    image_small = median(image_scaled, weight_small)
 
-    # Subtraction of means
-    mean_large = n_large.mean(axis=2)
-    mean_small = n_small.mean(axis=2)
-    for k in range(n):
-        n_large[:, :, k] -= mean_large
-        n_small[:, :, k] -= mean_small
+    # Neighbour locations and interpolation weights
+    shape = np.shape(image_center)
+    offsets_large, weights_large = neighbour_taps(r_large, n, dist, eps=eps)
+    offsets_small, weights_small = neighbour_taps(r_small, n, dist, eps=eps)
 
     # Converting to binary images and taking the lbp values
+    lbp_large, lbp_small, lbp_radial = lbp_codes(
+        lambda k: sample_neighbour(image_large, offsets_large[k], weights_large[k], shape),
+        lambda k: sample_neighbour(image_small, offsets_small[k], weights_small[k], shape), n,
+        out=(workspace['lbp_large'], workspace['lbp_small'], workspace['lbp_radial']))
 
-    # Initialization of arrays
-    lbp_large = np.zeros((row, col))
-    lbp_small = np.zeros((row, col))
-    lbp_radial = np.zeros((row, col))
+    # Rotation invariant uniform histograms
+    large_hist = riu2_histogram(lbp_large, n)
+    small_hist = riu2_histogram(lbp_small, n)
+    radial_hist = riu2_histogram(lbp_radial, n)
 
-    for k in range(n):
-        lbp_large += (n_large[:, :, k] >= 0) * 2 ** k  # NOTE ACCURACY FOR THRESHOLDING!!!
-        lbp_small += (n_small[:, :, k] >= 0) * 2 ** k
-        lbp_radial += (n_radial[:, :, k] >= 0) * 2 ** k
-        # --------------- #
-        # lbp_large += (n_large[:,:,k] >= -(eps ** 2)) * 2 ** k  # NOTE ACCURACY FOR THRESHOLDING!!!
-        # lbp_small += (n_small[:,:,k] >= -(eps ** 2)) * 2 ** k
-        # lbp_radial += (n_radial[:,:,k] >= -(eps ** 2)) * 2 ** k
-        # --------------- #
-
-    # Calculating histograms with 2 ^ N bins
-    large_hist = np.zeros((1, 2**n))
-    small_hist = np.zeros((1, 2**n))
-    radial_hist = np.zeros((1, 2**n))
-    for k in range(2**n):
-        large_hist[0, k] = np.sum(lbp_large == k)
-        small_hist[0, k] = np.sum(lbp_small == k)
-        radial_hist[0, k] = np.sum(lbp_radial == k)
-
-    # Rotation invariant uniform mapping
-    mapping = get_mapping(n)
-    large_hist = map_lbp(large_hist, mapping)
-    small_hist = map_lbp(small_hist, mapping)
-    radial_hist = map_lbp(radial_hist, mapping)
-
-    # # Individual histogram normalization
-    # if  normalize:
-    #     center_hist /= np.sum(center_hist)
-    #     large_hist /= np.sum(large_hist)
-    #     small_hist /= np.sum(small_hist)
-    #     radial_hist /= np.sum(radial_hist)
-
-    # Concatenate histograms
-    hist = np.concatenate((center_hist, large_hist, small_hist, radial_hist), 1)
+    return (center_hist, large_hist, small_hist, radial_hist), (lbp_large, lbp_small, lbp_radial), image_center
 
-    if normalize:
-        hist /= np.sum(hist)
 
-    if args.save_images and args is not None and (('21_L3L' in sample) or ('20_R2M' in sample)):
+def lbp_codes(neighbour_large, neighbour_small, n, out=None):
+    """Calculates large, small and radial LBP images as bit-packed integer codes.
 
-        # Map LBP images
-        lbp_large_mapped = map_lbp(lbp_large, mapping)
-        lbp_small_mapped = map_lbp(lbp_small, mapping)
-        lbp_radial_mapped = map_lbp(lbp_radial, mapping)
-        lbp_list = [lbp_large_mapped, lbp_small_mapped, lbp_radial_mapped]
+    Neighbours are sampled one at a time, so that the (row, col, n) neighbour arrays are never stored.
+    Thresholding equals comparing each neighbour against the neighbourhood mean
+    (and large neighbours against small neighbours for the radial image).
 
-        # Load coefficients
-        coefs, _ = load_excel(args.save_path + '/' + 'weights_surf_sub.xlsx' , titles=['Weights_lin', 'Weights_log'])
-        thresh = 0.1
-        lin = coefs[0]
-        log = coefs[1]
-        lin = np.abs(np.insert(lin, [2, 9, 10, 17], 0)) > thresh
-        log = np.abs(np.insert(log, [2, 9, 10, 17], 0)) > thresh
+    Parameters
+    ----------
+    neighbour_large : function
+        Returns the k:th large radius neighbour image with shape (row, col) when called with k.
+    neighbour_small : function
+        Returns the k:th small radius neighbour image with shape (row, col) when called with k.
+    n : int
+        Number of neighbours.
+    out : tuple
+        Optional integer arrays (large, small, radial) for the output codes.
+    Returns
+    -------
+    LBP images (large, small, radial) as uint8 (n <= 8), uint16 (n <= 16) or uint32 arrays.
+    """
+    dtype = _code_dtype(n)
+
+    # Neighbourhood means
+    mean_large = _neighbour_sum(neighbour_large, n)
+    mean_large /= n
+    mean_small = _neighbour_sum(neighbour_small, n)
+    mean_small /= n
+
+    # Output arrays
+    if out is None:
+        out = tuple(np.zeros(mean_large.shape, dtype=dtype) for _ in range(3))
+    lbp_large, lbp_small, lbp_radial = out
+    for lbp in out:
+        lbp.fill(0)
+
+    # Set one bit per neighbour
+    for k in range(n):
+        bit = dtype(1 << k)
+        p_large = neighbour_large(k)
+        p_small = neighbour_small(k)
+        lbp_large |= (p_large >= mean_large) * bit  # NOTE ACCURACY FOR THRESHOLDING!!!
+        lbp_small |= (p_small >= mean_small) * bit
+        lbp_radial |= (p_large >= p_small) * bit
 
-        masks = [np.zeros(lbp_large.shape), np.zeros(lbp_large.shape), np.zeros(lbp_large.shape)]
+    return lbp_large, lbp_small, lbp_radial
 
-        for mask in range(len(masks)):
-            for ind in range(int(np.max(lbp_large_mapped)) + 1):
-                masks[mask] += (ind + 1) * (lbp_list[mask] == ind) * log[2+mask*10:2+(mask+1)*10][ind]
 
-        # No instances in LBP_large (0,8) and LBP_small (0,8)
-        print_images(lbp_list, subtitles=['Large', 'Small', 'Radial'], title=sample,
-                     sample=sample + '.png')
+@cached_kernel
+def neighbour_taps(radius, n, dist, method='bilinear', eps=1e-06):
+    """Integer offsets and interpolation weights for sampling n circular neighbours at given radius.
 
-    # Print center image
-    fig = plt.figure(dpi=300)
-    ax = fig.add_subplot(111)
-    ax.imshow(image_center >= 0)
-    plt.title('Center')
-    plt.savefig(args.save_path + '/Images/LBP/' + sample + '_center.png', transparent=True)
-    plt.close()
+    Neighbour images are gathered from shifted views of the image, see sample_neighbour.
+    Output pixel (i, j) corresponds to center pixel (i + dist, j + dist) of the input image.
 
-        # Print unmapped LBP
-        #print_images([lbp_large, lbp_small, lbp_radial], subtitles=['Large', 'Small', 'Radial'], title=sample,
-        #             save_path=args.save_path + '/Images/LBP/', sample=sample + '.png')
+    Parameters
+    ----------
+    radius : int
+        Distance of the neighbours from the center pixel.
+    n : int
+        Number of neighbours.
+    dist : int
+        Width of the cropped border. Should be at least radius (+ 1 for the kernel method).
+    method : str
+        'bilinear' reproduces the interpolation of MRELBP (image_bilinear).
+        Neighbours closer than eps to a pixel are not interpolated.
+        Weights are (wx1, wx2, wy1, wy2) for the taps (y1, x1), (y1, x2), (y2, x1), (y2, x2).
+        'kernel' reproduces the correlation with weight_matrix_bilin kernels used in Conv_MRELBP.
+        Weights are multiplied directly with the taps, taps with zero weight are skipped.
+    eps : float
+        Tolerance for integer neighbour locations in bilinear method.
+    Returns
+    -------
+    Offsets with shape (n, 4, 2) as (row, column) and weights with shape (n, 4).
+    """
+    offsets = np.zeros((n, 4, 2), dtype=np.intp)
+    weights = np.zeros((n, 4))
+    for k in range(n):
+        if method == 'bilinear':
+            # Angle to the neighbour
+            theta = k * (-1 * 2 * np.pi / n)
+            x = dist + radius * np.cos(theta)
+            y = dist + radius * np.sin(theta)
+            if abs(x - round(x)) < eps and abs(y - round(y)) < eps:
+                offsets[k, :] = [int(round(y)), int(round(x))]
+                weights[k] = [1, 0, 1, 0]
+                continue
+            # Same operations as in image_bilinear
+            x1, x2 = int(np.floor(x)), int(np.ceil(x))
+            y1, y2 = int(np.floor(y)), int(np.ceil(y))
+            offsets[k] = [[y1, x1], [y1, x2], [y2, x1], [y2, x2]]
+            weights[k] = [(x2 - x) / (x2 - x1 + 1e-12), (x - x1) / (x2 - x1 + 1e-12),
+                          (y2 - y) / (y2 - y1 + 1e-12), (y - y1) / (y2 - y1 + 1e-12)]
+        elif method == 'kernel':
+            kernel = weight_matrix_bilin(radius, -k * (np.pi * 2 / n), val=0)
+            # Correlation skips kernel values below machine epsilon
+            taps = np.argwhere(np.abs(kernel) > np.finfo(np.float64).eps)
+            offsets[k, :len(taps)] = taps + dist - kernel.shape[0] // 2
+            weights[k, :len(taps)] = kernel[taps[:, 0], taps[:, 1]]
+        else:
+            raise Exception('Unknown sampling method: {0}'.format(method))
+    return offsets, weights
 
-    return hist
 
+def sample_neighbour(image, offsets, weights, shape, method='bilinear'):
+    """Gathers one neighbour image from shifted views of the input image.
 
+    Parameters
+    ----------
+    image : ndarray
+        Input image.
+    offsets : ndarray
+        Tap offsets for the neighbour with shape (4, 2). See neighbour_taps.
+    weights : ndarray
+        Interpolation weights for the neighbour with shape (4,). See neighbour_taps.
+    shape : tuple
+        Shape of the neighbour image (rows, columns).
+    method : str
+        Sampling method used in neighbour_taps.
+    Returns
+    -------
+    Neighbour image with given shape. Can be a view of the input image.
+    """
+    row, col = shape
+    views = [image[dy:dy + row, dx:dx + col] for dy, dx in offsets]
+    if method == 'bilinear':
+        wx1, wx2, wy1, wy2 = weights
+        if wx1 == 1 and wx2 == 0 and wy1 == 1 and wy2 == 0:
+            return views[0]
+        return wy1 * (wx1 * views[0] + wx2 * views[1]) + wy2 * (wx1 * views[2] + wx2 * views[3])
+
+    neighbour = None
+    for view, weight in zip(views, weights):
+        if weight == 0:
+            continue
+        neighbour = view * weight if neighbour is None else neighbour + view * weight
+    return neighbour
+
+
+def _code_dtype(n):
+    """Smallest unsigned integer type holding n bit LBP codes."""
+    if n <= 8:
+        return np.uint8
+    elif n <= 16:
+        return np.uint16
+    return np.uint32
+
+
+def _neighbour_sum(neighbour, n):
+    """Sums n neighbour images with the same pairwise ordering as numpy reductions (axis length <= 128).
+
+    Matches stacking the neighbours into shape (row, col, n) and calling sum(axis=2) bit for bit,
+    which keeps thresholding of flat regions identical while storing at most a few images at a time.
+    """
+    if n < 8 or n > 128:
+        total = np.zeros(np.shape(neighbour(0)))
+        for k in range(n):
+            total += neighbour(k)
+        return total
+
+    def partial(j):
+        acc = np.array(neighbour(j), dtype=np.float64)
+        for i in range(8, n - n % 8, 8):
+            acc += neighbour(i + j)
+        return acc
+
+    total = ((partial(0) + partial(1)) + (partial(2) + partial(3))) + \
+            ((partial(4) + partial(5)) + (partial(6) + partial(7)))
+    for k in range(n - n % 8, n):
+        total += neighbour(k)
+    return total
+
+
+@cached_kernel
 def get_mapping(n=8):
     """Gets table for rotation invariant uniform mapping (riu2).
 
@@ -254,28 +829,44 @@ def get_mapping(n=8):
     -------
     Calculated mapping table with values from 0 to n + 1 and length of 2 ^ n.
     """
-    table = np.zeros((1, 2 ** n))
-    for k in range(2 ** n):
-        # Binary representation of bin number
-        binary_number = np.binary_repr(k, n)
-        # Convert string to list of digits
-        i_bin = np.zeros((1, len(binary_number)))
-        for ii in range(len(binary_number)):
-            i_bin[0, ii] = int(float(binary_number[ii]))
-        # Rotation
-        j_bin = np.roll(i_bin, -1)
-        # uniformity
-        num_difference = np.sum(i_bin != j_bin)
-        # Binning
-        if num_difference <= 2:
-            b = np.binary_repr(k, n)
-            c = 0
-            for ii in range(len(b)):
-                c = c+int(float(b[ii]))
-            table[0, k] = c
-        else:
-            table[0, k] = n + 1
-    return table
+    return _riu2_table(n).astype(np.float64).reshape(1, -1)
+
+
+@cached_kernel
+def _riu2_table(n):
+    """Builds the riu2 lookup table once per number of neighbours. Returns read-only integer table."""
+    # Binary digits of every bin number
+    codes = np.arange(2 ** n)
+    bits = (codes[:, None] >> np.arange(n)) & 1
+    # Uniformity (number of circular 0/1 transitions)
+    num_difference = np.sum(bits != np.roll(bits, -1, axis=1), axis=1)
+    # Binning
+    return np.where(num_difference <= 2, bits.sum(axis=1), n + 1).astype(np.intp)
+
+
+def riu2_histogram(lbp, n):
+    """Calculates rotation invariant uniform histogram from LBP image in a single pass.
+
+    Equal to map_lbp(histogram, get_mapping(n)), where histogram has 2 ^ n bins.
+
+    Parameters
+    ----------
+    lbp : ndarray
+        LBP image with integer codes from 0 to 2 ^ n - 1.
+    n : int
+        Number of LBP neighbours.
+    Returns
+    -------
+    Mapped histogram with shape (1, n + 2).
+    """
+    table = _riu2_table(n)
+    # Histogram with 2 ^ n bins
+    if not np.issubdtype(lbp.dtype, np.integer):
+        lbp = lbp.astype(np.intp)
+    hist = np.bincount(lbp.ravel(), minlength=2 ** n)
+    # Combine bins with the lookup table
+    mapped = np.bincount(table, weights=hist[:2 ** n], minlength=int(table.max()) + 1)
+    return mapped.reshape(1, -1)
 
 
 def map_lbp(bin_original, mapping):
@@ -336,7 +927,87 @@ def image_padding(im, padlength):
     return im_pad
 
 
-def local_standard(image, parameters, eps=1e-09, normalize='gaussian'):
+def median_filter(image, kernel, method='scipy', n_threads=1, levels=256):
+    """Median filtering with zero padded boundaries (equal to scipy.signal.medfilt2d).
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image.
+    kernel : int
+        Kernel size (odd).
+    method : str
+        'scipy' calculates exact median with medfilt2d. Image is split into horizontal strips
+        processed by n_threads threads.
+        'histogram' uses constant time histogram median (Perreault & Hebert, OpenCV medianBlur)
+        on image quantized to given number of levels. Result is exact if the image (with zero padding)
+        has at most levels unique values, otherwise error is at most half of a quantization step.
+        OpenCV distributes the work to its own thread pool.
+    n_threads : int
+        Number of threads used by the exact method.
+    levels : int
+        Number of quantization levels used by the histogram method (at most 256).
+    Returns
+    -------
+    Median filtered image (float64).
+    """
+    if kernel <= 1:
+        return np.array(image, dtype=np.float64)
+    if method == 'histogram':
+        return _median_histogram(image, kernel, levels=levels)
+    elif method != 'scipy':
+        raise Exception('Unknown median filtering method: {0}'.format(method))
+
+    rows = image.shape[0]
+    n_threads = max(min(n_threads, rows // max(kernel, 1)), 1)
+    if n_threads == 1:
+        return medfilt2d(np.array(image, dtype=np.float64), kernel)
+
+    # Strips overlap by half of the kernel, so that every output row sees the same neighbourhood
+    pad = kernel // 2
+    bounds = np.linspace(0, rows, n_threads + 1).astype(int)
+
+    def strip(i):
+        start, end = bounds[i], bounds[i + 1]
+        low, high = max(start - pad, 0), min(end + pad, rows)
+        filtered = medfilt2d(np.array(image[low:high], dtype=np.float64), kernel)
+        return filtered[start - low:end - low]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        strips = list(pool.map(strip, range(n_threads)))
+    return np.concatenate(strips, axis=0)
+
+
+def worker_threads(args, n_workers=1):
+    """Returns median filtering threads per worker, so that n_workers concurrent workers
+    together use at most args.median_threads threads (at least one each)."""
+    return max(1, args.median_threads // max(1, n_workers))
+
+
+def _median_histogram(image, kernel, levels=256):
+    """Histogram based median filter on quantized image. See median_filter."""
+    pad = kernel // 2
+    # Zero padding is included in quantization
+    values = np.pad(np.asarray(image, dtype=np.float64), pad, mode='constant')
+
+    unique, inverse = np.unique(values, return_inverse=True)
+    if unique.size <= levels:
+        # Lossless quantization to ranks
+        quantized = inverse.reshape(values.shape).astype(np.uint8)
+        lookup = unique
+    else:
+        low, high = unique[0], unique[-1]
+        step = (high - low) / (levels - 1)
+        quantized = np.round((values - low) / step).astype(np.uint8)
+        lookup = low + np.arange(levels) * step
+
+    filtered = cv2.medianBlur(quantized, kernel)
+    if pad > 0:
+        filtered = filtered[pad:-pad, pad:-pad]
+    return lookup[filtered]
+
+
+def local_standard(image, parameters, eps=1e-09, normalize='gaussian', method='direct'):
     """Centers and standardizes local grayscales with Gaussian weighted mean.
 
     Parameters
@@ -354,6 +1025,8 @@ def local_standard(image, parameters, eps=1e-09, normalize='gaussian'):
     normalize : str
         Normalizing method used to create Gaussian kernels.
         Defaults to division by 2 * Pi * sigma ^ 2, but division by kernel sum is also possible.
+    method : str
+        Filtering backend. See gauss_filter. Defaults to direct 2D convolution.
     Returns
     -------
     Image normalized to local contrast.
@@ -364,18 +1037,25 @@ def local_standard(image, parameters, eps=1e-09, normalize='gaussian'):
     sigma1 = parameters['sigma1']
     sigma2 = parameters['sigma2']
 
-    # Gaussian kernels
-    kernel1 = gauss_kernel(w1, sigma1, normalize=normalize)
-    kernel2 = gauss_kernel(w2, sigma2, normalize=normalize)
     # Calculate mean and standard deviation images
-    mean = convolve(image, kernel1)
-    std = convolve(image ** 2, kernel2) ** 0.5
+    if method == 'direct':
+        # Gaussian kernels
+        kernel1 = gauss_kernel(w1, sigma1, normalize=normalize)
+        kernel2 = gauss_kernel(w2, sigma2, normalize=normalize)
+        mean = convolve(image, kernel1)
+        std = convolve(image ** 2, kernel2) ** 0.5
+    else:
+        mean = gauss_filter(image, gauss_kernel_1d(w1, sigma1, normalize=normalize), sigma1, method=method,
+                            convolution=True)
+        std = gauss_filter(image ** 2, gauss_kernel_1d(w2, sigma2, normalize=normalize), sigma2, method=method,
+                           convolution=True) ** 0.5
     # Centering grayscale values
     image_centered = image - mean
     # Standardization
     return image_centered / (std + eps)
 
 
+@cached_kernel
 def gauss_kernel(w, sigma, normalize='gaussian'):
     """Generates 2d gaussian kernel.
 
@@ -392,13 +1072,9 @@ def gauss_kernel(w, sigma, normalize='gaussian'):
     -------
     Gaussian kernel with shape (w, w).
     """
-    kernel = np.zeros((w, w))
-    # Constant for centering
-    r = (w - 1) / 2
-    for ii in range(w):
-        for jj in range(w):
-            x = -((ii - r) ** 2 + (jj - r) ** 2) / (2 * sigma ** 2)
-            kernel[ii, jj] = np.exp(x)
+    # Squared distances from the center
+    d = (np.arange(w) - (w - 1) / 2) ** 2
+    kernel = np.exp(-(d[:, None] + d[None, :]) / (2 * sigma ** 2))
     # Normalizing the kernel
     if normalize == 'sum':
         return kernel / np.sum(kernel)
@@ -406,7 +1082,112 @@ def gauss_kernel(w, sigma, normalize='gaussian'):
         return kernel / (2 * np.pi * sigma ** 2)
 
 
-def Conv_MRELBP(image, pars, savepath=None, sample=None, normalize=True):
+@cached_kernel
+def gauss_kernel_1d(w, sigma, normalize='gaussian'):
+    """Generates 1d gaussian kernel. Outer product of the kernel with itself equals gauss_kernel.
+
+    Parameters
+    ----------
+    w : int
+        Kernel width.
+    sigma : int
+        Standard deviation of Gaussian kernel.
+    normalize : str
+        Normalizing method used to create Gaussian kernels.
+        Defaults to division by sqrt(2 * Pi) * sigma, but division by kernel sum is also possible.
+    Returns
+    -------
+    Gaussian kernel with shape (w,).
+    """
+    kernel = np.exp(-(np.arange(w) - (w - 1) / 2) ** 2 / (2 * sigma ** 2))
+    # Normalizing the kernel
+    if normalize == 'sum':
+        return kernel / np.sum(kernel)
+    else:
+        return kernel / (np.sqrt(2 * np.pi) * sigma)
+
+
+def gauss_filter(image, kernel, sigma, method='separable', convolution=False):
+    """Filters image with a separable Gaussian kernel.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image.
+    kernel : ndarray
+        1D Gaussian kernel. Filtering corresponds to the 2D kernel np.outer(kernel, kernel).
+    sigma : float
+        Standard deviation of the kernel. Used only by the recursive method.
+    method : str
+        'separable' filters rows and columns with the 1D kernel. Equal to 2D filtering within rounding error.
+        'recursive' uses recursive Gaussian filter with a cost that does not depend on sigma.
+        Recursive filter approximates an untruncated Gaussian, so it is used only when kernel width
+        is at least 6 * sigma and sigma >= 2. Truncated kernels and small sigmas fall back to the separable method.
+    convolution : bool
+        Choice whether to use convolution instead of correlation (differs only for asymmetric kernels).
+    Returns
+    -------
+    Filtered image.
+    """
+    if method == 'recursive' and len(kernel) >= 6 * sigma and sigma >= 2:
+        # Recursive filter has unit sum, scale to the sum of the 2D kernel
+        return recursive_gauss(image, sigma) * np.sum(kernel) ** 2
+    elif method in ['separable', 'recursive']:
+        filt = convolve1d if convolution else correlate1d
+        return filt(filt(image, kernel, axis=0), kernel, axis=1)
+    else:
+        raise Exception('Unknown filtering method: {0}'.format(method))
+
+
+def recursive_gauss(image, sigma):
+    """Recursive (IIR) Gaussian filter (Young & van Vliet, 1995). Processing time does not depend on sigma.
+
+    Image is symmetrically padded with 4 * sigma pixels, corresponding to reflected boundaries in scipy.ndimage.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image.
+    sigma : float
+        Standard deviation of the Gaussian. Should be at least 0.5.
+        Approximation error compared to sampled Gaussian kernels is largest for sigma < 2.
+    Returns
+    -------
+    Filtered image.
+    """
+    if sigma < 0.5:
+        raise Exception('Recursive Gaussian requires sigma >= 0.5')
+
+    # Filter coefficients
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * np.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = 2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3
+    b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3)
+    b3 = 0.422205 * q ** 3
+    b = [1 - (b1 + b2 + b3) / b0]
+    a = [1, -b1 / b0, -b2 / b0, -b3 / b0]
+    zi = lfilter_zi(b, a)
+
+    # Padding
+    pad = int(np.ceil(4 * sigma))
+    out = np.pad(np.asarray(image, dtype=np.float64), pad, mode='symmetric')
+
+    # Causal and anti-causal passes along both axes
+    for axis in [0, 1]:
+        for _ in range(2):
+            shape = [1, 1]
+            shape[axis] = len(zi)
+            initial = zi.reshape(shape) * np.take(out, [0], axis=axis)
+            out, _ = lfilter(b, a, out, axis=axis, zi=initial)
+            out = np.flip(out, axis=axis)
+
+    return out[pad:-pad, pad:-pad]
+
+
+def Conv_MRELBP(image, pars, savepath=None, sample=None, normalize=True, median_method='scipy'):
     """Calculates MRELBP using convolutions. Alternate method for calculating LBP features."""
     # Unpack parameters
     n = pars['N']
@@ -420,90 +1201,34 @@ def Conv_MRELBP(image, pars, savepath=None, sample=None, normalize=True):
     imu = image.mean()
     istd = image.std()
     im = (image - imu) / istd
-    # Get image dimensions
-    h, w = im.shape[:2]
-    # Make kernels
-    kR = []
-    kr = []
-    dtheta = np.pi * 2 / n
-    for k in range(0, n):
-        _kernel = weight_matrix_bilin(r_large, -k * dtheta, val=0)
-        kR.append(_kernel)
-
-        _kernel = weight_matrix_bilin(r_small, -k * dtheta, val=0)
-        kr.append(_kernel)
-
     # Make median filtered images
-    imc = medfilt2d(im.copy(), w_center)
-    imR = medfilt2d(im.copy(), w_large)
-    imr = medfilt2d(im.copy(), w_small)
-
-    # Get LBP images
-    neighbR = np.zeros((h, w, n))
-    neighbr = np.zeros((h, w, n))
-    for k in range(n):
-        _neighb = correlate(imR, kR[k])
-        neighbR[:, :, k] = _neighb
-        _neighb = correlate(imr, kr[k])
-        neighbr[:, :, k] = _neighb
+    imc = median_filter(im, w_center, method=median_method)
+    imR = median_filter(im, w_large, method=median_method)
+    imr = median_filter(im, w_small, method=median_method)
 
     # Crop valid convolution region
     d = r_large + w_large // 2
-    h -= 2 * d
-    w -= 2 * d
-
-    neighbR = neighbR[d:-d, d:-d, :]
-    neighbr = neighbr[d:-d, d:-d, :]
     imc = imc[d:-d, d:-d]
 
-    # Subtraction
-    _muR = neighbR.mean(2).reshape(h, w, 1)
-    for k in range(n):
-        try:
-            muR = np.concatenate((muR, _muR), 2)
-        except NameError:
-            muR = _muR
+    # Neighbour taps of the bilinear kernels
+    offsets_R, weights_R = neighbour_taps(r_large, n, d, method='kernel')
+    offsets_r, weights_r = neighbour_taps(r_small, n, d, method='kernel')
+
+    # Get LBP images, neighbours are calculated one at a time
+    lbpc = (imc - imc.mean()) >= 0
+    lbpR, lbpr, lbpR_r = lbp_codes(
+        lambda k: sample_neighbour(imR, offsets_R[k], weights_R[k], imc.shape, method='kernel'),
+        lambda k: sample_neighbour(imr, offsets_r[k], weights_r[k], imc.shape, method='kernel'), n)
 
-    _mur = neighbr.mean(2).reshape(h, w, 1)
-    for k in range(n):
-        try:
-            mur = np.concatenate((mur, _mur), 2)
-        except NameError:
-            mur = _mur
-
-    diffc = (imc - imc.mean()) >= 0
-    diffR = (neighbR - muR) >= 0
-    diffr = (neighbr - mur) >= 0
-    diffR_r = (neighbR - neighbr) >= 0
-
-    # Compute lbp images
-    lbpc = diffc
-    lbpR = np.zeros((h, w))
-    lbpr = np.zeros((h, w))
-    lbpR_r = np.zeros((h, w))
-    for k in range(n):
-        lbpR += diffR[:, :, k] * (2 ** k)
-        lbpr += diffr[:, :, k] * (2 ** k)
-        lbpR_r += diffR_r[:, :, k] * (2 ** k)
     # Get LBP histograms
     histc = np.zeros((1, 2))
-    histR = np.zeros((1, 2 ** n))
-    histr = np.zeros((1, 2 ** n))
-    histR_r = np.zeros((1, 2 ** n))
-
     histc[0, 0] = (lbpc == 1).astype(np.float32).sum()
     histc[0, 1] = (lbpc == 0).astype(np.float32).sum()
 
-    for k in range(2 ** n):
-        histR[0, k] = (lbpR == k).astype(np.float32).sum()
-        histr[0, k] = (lbpr == k).astype(np.float32).sum()
-        histR_r[0, k] = (lbpR_r == k).astype(np.float32).sum()
-
-    # Mapping
-    mapping = get_mapping(n)
-    histR = map_lbp(histR, mapping)
-    histr = map_lbp(histr, mapping)
-    histR_r = map_lbp(histR_r, mapping)
+    # Rotation invariant uniform mapping
+    histR = riu2_histogram(lbpR, n)
+    histr = riu2_histogram(lbpr, n)
+    histR_r = riu2_histogram(lbpR_r, n)
 
     # Histogram normalization
     if normalize:
@@ -522,6 +1247,7 @@ def Conv_MRELBP(image, pars, savepath=None, sample=None, normalize=True):
     return hist
 
 
+@cached_kernel
 def make_2d_gauss(ks, sigma):
     """Gaussian kernel used in OARSI abstract"""
     # Mean indices
@@ -549,27 +1275,46 @@ def make_2d_gauss(ks, sigma):
     return kernel
 
 
-def local_normalize_abs(image, parameters, eps=1e-09):
-    """Standardization used in OARSI abstract"""
+@cached_kernel
+def make_1d_gauss(ks, sigma):
+    """1D factor of the Gaussian kernel used in OARSI abstract. Normalized to unit sum."""
+    x = (np.linspace(0, ks - 1, ks) - ks // 2) ** 2
+    kernel = np.exp(-0.5 * x / sigma ** 2)
+    return kernel / kernel.sum()
+
+
+def local_normalize_abs(image, parameters, eps=1e-09, method='direct'):
+    """Standardization used in OARSI abstract
+
+    Filtering backend can be chosen with method: 'direct' (2D correlation), 'separable' or 'recursive'.
+    See gauss_filter."""
     # Unpack
     ks1 = parameters['ks1']
     ks2 = parameters['ks2']
     sigma1 = parameters['sigma1']
     sigma2 = parameters['sigma2']
 
-    # Generate gaussian kernel
-    kernel1 = make_2d_gauss(ks1, sigma1)
-    kernel2 = make_2d_gauss(ks2, sigma2)
+    if method == 'direct':
+        # Generate gaussian kernel
+        kernel1 = make_2d_gauss(ks1, sigma1)
+        kernel2 = make_2d_gauss(ks2, sigma2)
+
+        mu = correlate(image, kernel1)
 
-    mu = correlate(image, kernel1)
+        centered = image - mu
+
+        sd = correlate(centered ** 2, kernel2) ** 0.5
+    else:
+        mu = gauss_filter(image, make_1d_gauss(ks1, sigma1), sigma1, method=method)
 
-    centered = image - mu
+        centered = image - mu
 
-    sd = correlate(centered ** 2, kernel2) ** 0.5
+        sd = gauss_filter(centered ** 2, make_1d_gauss(ks2, sigma2), sigma2, method=method) ** 0.5
 
     return centered / (sd + eps)
 
 
+@cached_kernel
 def weight_matrix_bilin(r, theta, val=-1):
     """Bilinear interpolation used in Conv_MRELBP."""
     # Center of the matrix
@@ -1,11 +1,12 @@
 """Contains resources for PCA dimensionality reduction and creating regression models."""
 
 import numpy as np
-import shap
+import os
+import pandas as pd
 import matplotlib.pyplot as plt
 
 
-from joblib import dump
+from joblib import dump, Parallel, delayed
 from pathlib import Path
 from time import strftime
 
@@ -14,9 +15,10 @@ from sklearn.linear_model import Ridge, LogisticRegression, Lasso, LinearRegress
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import mean_squared_error, r2_score
 from sklearn.model_selection import LeaveOneOut, LeaveOneGroupOut
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 
 from components.utilities.load_write import load_binary_weights
+from components.grading.interpretability import explain_logo, summary_plots, submit
 
 
 def regress_loo(features, grades, method='ridge', standard=False, use_intercept=True, groups=None, convert='none', alpha=1.0):
@@ -53,6 +55,13 @@ def regress_loo(features, grades, method='ridge', standard=False, use_intercept=
     else:
         pass
 
+    # Exact ridge predictions from fold downdates
+    if method == 'ridge':
+        folds = [test_idx for _, test_idx in LeaveOneOut().split(features)]
+        predictions, coefs, intercepts = ridge_cv(features, grades, folds, alpha=alpha,
+                                                  use_intercept=use_intercept, standard=standard)
+        return np.array(predictions).squeeze(), coefs[-1], intercepts[-1]
+
     predictions = []
     # Get leave-one-out split
     loo = LeaveOneOut()
@@ -68,10 +77,7 @@ def regress_loo(features, grades, method='ridge', standard=False, use_intercept=
             x_train -= x_train.mean(0)
 
         # Linear regression
-        if method == 'ridge':
-            model = Ridge(alpha=alpha, normalize=True, random_state=42, fit_intercept=use_intercept)
-        else:
-            model = Lasso(alpha=alpha, normalize=True, random_state=42, fit_intercept=use_intercept)
+        model = Lasso(alpha=alpha, normalize=True, random_state=42, fit_intercept=use_intercept)
         model.fit(x_train, y_train)
 
         # Evaluate on test sample
@@ -129,7 +135,16 @@ def regress_logo(features, grades, groups, method='ridge', standard=False, use_i
     logo.get_n_splits(features, grades, groups)
     logo.get_n_splits(groups=groups)  # 'groups' is always required
 
-    for train_idx, test_idx in logo.split(features, grades, groups):
+    # Exact ridge predictions from group downdates
+    if method == 'ridge':
+        folds = [test_idx for _, test_idx in logo.split(features, grades, groups)]
+        predictions, coefs, intercepts = ridge_cv(features, grades, folds, alpha=alpha,
+                                                  use_intercept=use_intercept, standard=standard)
+        folds = []
+    else:
+        folds = logo.split(features, grades, groups)
+
+    for train_idx, test_idx in folds:
         # Indices
         x_train, x_test = features[train_idx], features[test_idx]
         y_train, y_test = grades[train_idx], grades[test_idx]
@@ -140,9 +155,7 @@ def regress_logo(features, grades, groups, method='ridge', standard=False, use_i
             x_train -= x_train.mean(0)
 
         # Linear regression
-        if method == 'ridge':
-            model = Ridge(alpha=alpha, normalize=True, random_state=42, fit_intercept=use_intercept)
-        elif method == 'lasso':
+        if method == 'lasso':
             model = Lasso(alpha=alpha, normalize=True, random_state=42, fit_intercept=use_intercept)
         else:
             model = LinearRegression(normalize=True, fit_intercept=use_intercept, n_jobs=-1)
@@ -170,7 +183,203 @@ def regress_logo(features, grades, groups, method='ridge', standard=False, use_i
     return predictions, np.mean(np.array(coefs), axis=0), np.mean(np.array(intercepts), axis=0)
 
 
-def logistic_loo(features, grades, standard=False, seed=42, use_intercept=False, groups=None):
+def ridge_cv(features, grades, folds, alpha=1.0, use_intercept=True, standard=False):
+    """Calculates cross-validated ridge regression predictions without refitting the model on each split.
+
+    Reproduces Ridge(alpha, normalize=True) fitted on each training split. The Gram matrix and cross products
+    of the full data are computed once, and each split is obtained by removing the test samples from them
+    (leave-one-out is the special case of single sample folds). Training split centering and column scaling of
+    the normalized ridge are applied to the downdated statistics, so that only a small linear system
+    (n_features x n_features) is solved per split.
+
+    Parameters
+    ----------
+    features : ndarray
+        Input features used in creating regression model.
+    grades : ndarray
+        Ground truth for the model.
+    folds : list
+        Test indices of each split. Training split contains the remaining samples.
+    alpha : float
+        Regularization coefficient.
+    use_intercept : bool
+        Choice whether to use intercept term on the model.
+        Features are normalized only when intercept is used, similar to scikit-learn.
+    standard : bool
+        Choice whether to center features by the mean of training split.
+    Returns
+    -------
+    List of predictions on each split, array of model coefficients and array of intercept terms for each split.
+    """
+    n_features = np.shape(features)[1]
+    predictions = []
+    coefs = np.zeros((len(folds), n_features))
+    intercepts = np.zeros(len(folds))
+    for fold, (gram, cross, squares, n, x_test, mean_x, mean_y) \
+            in enumerate(ridge_statistics(features, grades, folds, use_intercept, standard)):
+        coef = ridge_solve(gram, cross, squares, n, alpha, use_intercept)
+
+        # Predict on test split
+        predictions.append(np.dot(x_test, coef) + mean_y)
+        coefs[fold] = coef
+        if use_intercept:
+            intercepts[fold] = mean_y
+            if not standard:
+                intercepts[fold] -= np.dot(mean_x, coef)
+
+    return predictions, coefs, intercepts
+
+
+def ridge_statistics(features, grades, folds, use_intercept=True, standard=False):
+    """Yields sufficient statistics of ridge regression for each training split.
+
+    The Gram matrix and cross products of the full data are computed once and the test samples are removed
+    from them. The statistics are centered by the training split mean if intercept or centering is used.
+
+    Parameters
+    ----------
+    features : ndarray
+        Input features used in creating regression model.
+    grades : ndarray
+        Ground truth for the model.
+    folds : list
+        Test indices of each split.
+    use_intercept : bool
+        Choice whether to use intercept term on the model.
+    standard : bool
+        Choice whether to center features by the mean of training split.
+    Returns
+    -------
+    Generator of Gram matrix, cross products, uncentered squared column sums, number of training samples,
+    centered test features, training split feature mean and training split grade mean
+    (zero if intercept is not used).
+    """
+    x = np.asarray(features, dtype=np.float64)
+    y = np.asarray(grades, dtype=np.float64)
+    n_samples, n_features = x.shape
+    center = use_intercept or standard
+
+    # Shift by full data mean to reduce cancellation in the downdates
+    offset_x = x.mean(0) if center else np.zeros(n_features)
+    offset_y = y.mean() if use_intercept else 0.0
+    x0, y0 = x - offset_x, y - offset_y
+
+    # Full data statistics
+    gram = np.dot(x0.T, x0)
+    cross = np.dot(x0.T, y0)
+    sum_x, sum_y = x0.sum(0), y0.sum()
+
+    for test_idx in folds:
+        x_test, y_test = x0[test_idx], y0[test_idx]
+        n = n_samples - len(test_idx)
+
+        # Remove test samples
+        g = gram - np.dot(x_test.T, x_test)
+        c = cross - np.dot(x_test.T, y_test)
+        mean_x = (sum_x - x_test.sum(0)) / n if center else np.zeros(n_features)
+        sum_train = sum_y - y_test.sum()
+
+        # Center features by training split mean
+        squares = np.diag(g).copy()
+        if center:
+            g -= n * np.outer(mean_x, mean_x)
+            c -= mean_x * sum_train
+
+        mean_y = sum_train / n + offset_y if use_intercept else 0.0
+        yield g, c, squares, n, x_test - mean_x, mean_x + offset_x, mean_y
+
+
+def ridge_solve(gram, cross, squares, n, alpha, use_intercept=True):
+    """Solves ridge regression coefficients from centered split statistics (see ridge_statistics).
+
+    With intercept, regularization is scaled with the squared norms of the centered columns,
+    which equals Ridge(normalize=True).
+    """
+    n_features = gram.shape[0]
+    if use_intercept:
+        scale = np.diag(gram).copy()
+        scale[scale <= np.finfo(np.float64).eps * n * squares] = 1.0  # Constant columns
+    else:
+        scale = np.ones(n_features)
+    gram = gram.copy()
+    gram[np.diag_indices(n_features)] += alpha * scale
+    return np.linalg.solve(gram, cross)
+
+
+def regression_sweep(features, grades, alphas, components, groups=None, convert='none', loss=mean_squared_error):
+    """Calculates cross-validation loss of PCA + ridge regression for a grid of regularization coefficients
+    and numbers of PCA components.
+
+    Singular value decomposition of the features is calculated once. Whitened PCA scores with k components are
+    the first k columns of the full score matrix, so that split statistics are calculated once as well and only
+    the leading k x k block is solved for each grid point. Each point equals scikit_pca with whitening followed by
+    regress_loo or regress_logo (ridge, intercept, no centering), as used in regression_loss.
+
+    Parameters
+    ----------
+    features : ndarray
+        Standardized features (samples x features).
+    grades : ndarray
+        Ground truth for the model.
+    alphas : list
+        Regularization coefficients.
+    components : list
+        Numbers of PCA components.
+    groups : ndarray
+        Patients groups. Leave-one-group-out split is used if given, otherwise leave-one-out.
+    convert : str
+        Possibility to predict exp or log of ground truth. Defaults to no conversion.
+    loss : function
+        Error metric, called as loss(predictions, grades).
+    Returns
+    -------
+    Loss surface as a dataframe with numbers of components as index and alphas as columns.
+    """
+    x = np.asarray(features, dtype=np.float64)
+    if max(components) > min(x.shape):
+        raise Exception('Number of PCA components can not exceed {0}!'.format(min(x.shape)))
+
+    # Convert grades
+    if convert == 'exp':
+        targets = np.exp(grades)
+    elif convert == 'log':
+        targets = np.log(grades)
+    else:
+        targets = grades
+
+    # Whitened PCA scores for the largest number of components
+    u, _, _ = np.linalg.svd(x - x.mean(0), full_matrices=False)
+    score = u[:, :max(components)] * np.sqrt(x.shape[0] - 1)
+
+    # Split statistics
+    if groups is None:
+        folds = [test_idx for _, test_idx in LeaveOneOut().split(score)]
+    else:
+        folds = [test_idx for _, test_idx in LeaveOneGroupOut().split(score, targets, groups)]
+    statistics = list(ridge_statistics(score, targets, folds))
+
+    surface = np.zeros((len(components), len(alphas)))
+    for i, k in enumerate(components):
+        for j, alpha in enumerate(alphas):
+            predictions = []
+            for gram, cross, squares, n, x_test, _, mean_y in statistics:
+                coef = ridge_solve(gram[:k, :k], cross[:k], squares[:k], n, alpha)
+                predictions.append(np.dot(x_test[:, :k], coef) + mean_y)
+            predictions = np.concatenate(predictions)
+
+            # Convert grades back (leave-one-group-out, see regress_logo)
+            if groups is not None and convert == 'exp':
+                predictions = np.log(predictions)
+            elif groups is not None and convert == 'log':
+                predictions = np.exp(predictions)
+
+            surface[i, j] = loss(predictions, grades)
+
+    return pd.DataFrame(surface, index=pd.Index(components, name='n_components'),
+                        columns=pd.Index(alphas, name='alpha'))
+
+
+def logistic_loo(features, grades, standard=False, seed=42, use_intercept=False, groups=None, n_jobs=1):
     """Calculates logistic regression with leave-one-out split.
 
     Parameters
@@ -189,40 +398,22 @@ def logistic_loo(features, grades, standard=False, seed=42, use_intercept=False,
         If the model does not provide very powerful predictions, it is better to center them by the intercept.
     groups : ndarray
         Patients groups. Used in leave-one-group-out split.
+    n_jobs : int
+        Number of parallel jobs used to fit the splits.
     Returns
     -------
     Array of model prdictions, model coefficients and model intercept term.
     """
-    predictions = []
     # Leave one out split
     loo = LeaveOneOut()
-    for train_idx, test_idx in loo.split(features):
-        # Indices
-        x_train, x_test = features[train_idx], features[test_idx]
-        y_train, y_test = grades[train_idx], grades[test_idx]
+    models, predictions = logistic_cv(features, grades, list(loo.split(features)), standard=standard, seed=seed,
+                                      use_intercept=use_intercept, n_jobs=n_jobs)
+    model = models[-1]
 
-        # Normalize with mean and std
-        if standard:
-            x_test -= x_train.mean(0)
-            x_train -= x_train.mean(0)
+    return np.concatenate(predictions), model.coef_, model.intercept_
 
-        # Linear regression
-        model = LogisticRegression(solver='newton-cg', max_iter=1000, random_state=seed, fit_intercept=use_intercept)
-        model.fit(x_train, y_train)
-
-        # Predicted score
-        p = model.predict_proba(x_test)
-        predictions.append(p)
 
-    predictions_flat = []
-    for group in predictions:
-        for p in group:
-            predictions_flat.append(p)
-
-    return np.array(predictions_flat)[:, 1], model.coef_, model.intercept_
-
-
-def logistic_logo(features, grades, groups, standard=False, seed=42, use_intercept=False):
+def logistic_logo(features, grades, groups, standard=False, seed=42, use_intercept=False, n_jobs=1):
     """Calculates logistic regression with leave-one-group-out split and L2 regularization.
 
     Parameters
@@ -241,44 +432,108 @@ def logistic_logo(features, grades, groups, standard=False, seed=42, use_interce
         If the model does not provide very powerful predictions, it is better to center them by the intercept.
     groups : ndarray
         Patients groups. Used in leave-one-group-out split.
+    n_jobs : int
+        Number of parallel jobs used to fit the splits.
     Returns
     -------
     Array of model predictions, model coefficients and model intercept term.
     """
 
-    # Lists
-    predictions, coefs, intercepts = [], [], []
     # Leave one out split
     logo = LeaveOneGroupOut()
     logo.get_n_splits(features, grades, groups)
     logo.get_n_splits(groups=groups)  # 'groups' is always required
 
-    for train_idx, test_idx in logo.split(features, grades, groups):
-        # Indices
+    models, predictions = logistic_cv(features, grades, list(logo.split(features, grades, groups)),
+                                      standard=standard, seed=seed, use_intercept=use_intercept, n_jobs=n_jobs)
+
+    # Average coefficients
+    coefs = np.mean(np.array([model.coef_ for model in models]), axis=0).squeeze()
+    intercepts = np.mean(np.array([model.intercept_ for model in models]), axis=0).squeeze()
+
+    return np.concatenate(predictions), coefs, intercepts
+
+
+def logistic_cv(features, grades, splits, standard=False, seed=42, use_intercept=False, n_jobs=1):
+    """Fits logistic regression on each cross-validation split and predicts the test samples.
+
+    Parameters
+    ----------
+    features : ndarray
+        Input features used in creating regression model.
+    grades : ndarray
+        Binary ground truth for the model.
+    splits : list
+        Train and test indices of each split.
+    standard : bool
+        Choice whether to center features by the mean of training split.
+    seed : int
+        Random seed used in the model.
+    use_intercept : bool
+        Choice whether to use intercept term on the model.
+    n_jobs : int
+        Number of parallel jobs used to fit the splits.
+    Returns
+    -------
+    List of fitted models and list of positive class probabilities on the test samples of each split.
+    """
+    train_sets, test_sets = [], []
+    for train_idx, test_idx in splits:
         x_train, x_test = features[train_idx], features[test_idx]
-        y_train, y_test = grades[train_idx], grades[test_idx]
 
         # Normalize with mean and std
         if standard:
-            x_test -= x_train.mean(0)
-            x_train -= x_train.mean(0)
+            x_test = x_test - x_train.mean(0)
+            x_train = x_train - x_train.mean(0)
+        train_sets.append((x_train, grades[train_idx]))
+        test_sets.append(x_test)
 
-        # Linear regression
-        model = LogisticRegression(solver='newton-cg', max_iter=1000, random_state=seed, fit_intercept=use_intercept)
-        model.fit(x_train, y_train)
+    models = logistic_folds(train_sets, features, grades, seed=seed, use_intercept=use_intercept, n_jobs=n_jobs)
+    predictions = [model.predict_proba(x_test)[:, 1] for model, x_test in zip(models, test_sets)]
+    return models, predictions
 
-        # Predicted score
-        p = model.predict_proba(x_test)
-        predictions.extend(p[:, 1])  # Add the positive predictions to list
-        # Save weights
-        coefs.append(model.coef_)
-        intercepts.append(model.intercept_)
 
-    # Average coefficients
-    coefs = np.mean(np.array(coefs), axis=0).squeeze()
-    intercepts = np.mean(np.array(intercepts), axis=0).squeeze()
+def logistic_folds(train_sets, features, grades, seed=42, use_intercept=False, n_jobs=1):
+    """Fits logistic regression models on training splits.
 
-    return np.array(predictions), coefs, intercepts
+    A model is first fitted on the full data and its coefficients are used as the starting point of each split.
+    Training splits differ from the full data only by a few samples, so that newton-cg converges in a few iterations
+    instead of starting from zero. The optimum does not depend on the starting point.
+
+    Parameters
+    ----------
+    train_sets : list
+        Training features and ground truth of each split.
+    features : ndarray
+        Full data features used for the initial solution.
+    grades : ndarray
+        Full data ground truth used for the initial solution.
+    seed : int
+        Random seed used in the model.
+    use_intercept : bool
+        Choice whether to use intercept term on the model.
+    n_jobs : int
+        Number of parallel jobs used to fit the splits.
+    Returns
+    -------
+    List of fitted models.
+    """
+    model = LogisticRegression(solver='newton-cg', max_iter=1000, random_state=seed, fit_intercept=use_intercept)
+    model.fit(features, grades)
+
+    return Parallel(n_jobs=n_jobs)(delayed(_logistic_warm_start)(x_train, y_train, model.coef_, model.intercept_,
+                                                                  seed, use_intercept)
+                                   for x_train, y_train in train_sets)
+
+
+def _logistic_warm_start(x_train, y_train, coef, intercept, seed, use_intercept):
+    """Fits logistic regression starting from given coefficients."""
+    model = LogisticRegression(solver='newton-cg', max_iter=1000, random_state=seed, fit_intercept=use_intercept,
+                               warm_start=True)
+    model.coef_, model.intercept_ = coef.copy(), np.array(intercept, dtype=np.float64).copy()
+    model.fit(x_train, y_train)
+    model.warm_start = False
+    return model
 
 
 def rforest_logo(features, grades, groups, standard=False, seed=42, n_trees=50, tree_depth=None, savepath=None, zone=''):
@@ -387,43 +642,78 @@ def regress(data_x, data_y, split, method='ridge', standard=False):
 
 
 def pca_regress_pipeline_log(features, grades, groups, n_components=0.9, solver='full', whitening=True, standard=False,
-                             seed=42, mod_coefs=True, alpha=0.1, grade_name='', savepath=None):
+                             seed=42, mod_coefs=True, alpha=0.1, grade_name='', savepath=None, n_jobs=1,
+                             deferred=False):
+    """Trains PCA + logistic and linear regression models with leave-one-group-out split and draws
+    SHAP summary plots of the models.
 
-    feature_names = ['Center +', 'Center -', 'Large U-1', 'Large U-2', 'Large U-3', 'Large U-4', 'Large U-5', 'Large U-6',
-                     'Large U-7', 'Large N-U', 'Small U-1', 'Small U-2', 'Small U-3', 'Small U-4', 'Small U-5', 'Small U-6', 'Small U-7',
-                     'Small N-U', 'Radial U-0', 'Radial U-1', 'Radial U-2', 'Radial U-3', 'Radial U-4', 'Radial U-5', 'Radial U-6',
-                     'Radial U-7', 'Radial U-8', 'Radial N-U']
+    Parameters
+    ----------
+    features : ndarray
+        Input features (samples x features).
+    grades : ndarray
+        Ground truth for the model.
+    groups : ndarray
+        Patients groups.
+    mod_coefs : bool
+        Choice whether to check that merging PCA into the model coefficients gives equal predictions.
+        SHAP values are always calculated for the input features of the merged model (see interpretability.explain_logo).
+    deferred : bool
+        Choice whether to calculate SHAP values in a background worker. If True, plots are not drawn and
+        a Future of the SHAP values is returned (see interpretability.summary_plots).
+    Returns
+    -------
+    None, or Future of logistic and linear regression SHAP values if deferred is used.
+    """
     grades_log = grades
 
-    # Fit PCA to full data
+    # Fit PCA to full data and project once
     pca = PCA(n_components=n_components, svd_solver=solver, whiten=whitening, random_state=seed)
-    pca.fit(features)
+    score = pca.fit(features).transform(features)
 
     # Leave one out split
     logo = LeaveOneGroupOut()
     logo.get_n_splits(features, grades_log, groups)
     logo.get_n_splits(groups=groups)  # 'groups' is always required
-    all_shap_values, all_shap_values_lin = [], []
-    for train_idx, test_idx in logo.split(features, grades_log, groups):
+    splits = list(logo.split(features, grades_log, groups))
+
+    # PCA projections of the splits
+    train_sets, test_sets = [], []
+    for train_idx, test_idx in splits:
+        if standard:  # Normalize with mean and std
+            mean = features[train_idx].mean(0)
+            train_sets.append(pca.transform(features[train_idx] - mean))
+            test_sets.append(pca.transform(features[test_idx] - mean))
+        else:
+            train_sets.append(score[train_idx])
+            test_sets.append(score[test_idx])
+
+    # Logistic regression
+    models = logistic_folds([(score_train, grades_log[train_idx] > 1)
+                             for score_train, (train_idx, _) in zip(train_sets, splits)],
+                            score, grades_log > 1, seed=seed, use_intercept=False, n_jobs=n_jobs)
+
+    coefs, coefs_lin = [], []
+    for (train_idx, test_idx), score_train, score_test, model in zip(splits, train_sets, test_sets, models):
         # Indices
         x_train, x_test = features[train_idx], features[test_idx]
         y_train, y_test = grades_log[train_idx], grades_log[test_idx]
 
         # Normalize with mean and std
         if standard:
-            x_test -= x_train.mean(0)
-            x_train -= x_train.mean(0)
-
-        # Logistic regression
-        model = LogisticRegression(solver='newton-cg', max_iter=1000, random_state=seed, fit_intercept=False)
-        model.fit(pca.transform(x_train), y_train > 1)
+            x_test = x_test - x_train.mean(0)
+            x_train = x_train - x_train.mean(0)
 
         model_lin = Ridge(alpha=alpha, normalize=True, random_state=seed, fit_intercept=True)
-        model_lin.fit(pca.transform(x_train), y_train)
+        model_lin.fit(score_train, y_train)
 
         # Predicted score (for logistic regression)
-        p = model.predict_proba(pca.transform(x_test))
-        p_lin = model_lin.predict(pca.transform(x_test))
+        p = model.predict_proba(score_test)
+        p_lin = model_lin.predict(score_test)
+
+        # Coefficients of the PCA components
+        coefs.append(model.coef_)
+        coefs_lin.append(model_lin.coef_)
 
         # Merge PCA into the linear model
         if mod_coefs:
@@ -445,56 +735,15 @@ def pca_regress_pipeline_log(features, grades, groups, n_components=0.9, solver=
             assert np.sum(np.abs(p - p2)) < eps, 'LOGReg results are not equal'
             assert np.sum(np.abs(p_inf - p[:, 1])) < eps, 'LOGReg results are not equal'
             assert np.sum(np.abs(p_lin - p2_lin)) < eps, 'LINReg results are not equal'
-        else:  # Otherwise run PCA
-            x_train = pca.transform(x_train)
-            x_test = pca.transform(x_test)
 
-        # Interpretability
+    # Interpretability (closed form SHAP values of all splits)
+    if deferred:
+        return submit(explain_logo, features, splits, np.array(coefs), np.array(coefs_lin), pca)
+    shap_values, shap_values_lin = explain_logo(features, splits, np.array(coefs), np.array(coefs_lin), pca)
+    summary_plots(shap_values, shap_values_lin, features, grade_name=grade_name, savepath=savepath)
 
-        # Logistic regression
-        explainer = shap.LinearExplainer(model, x_train, feature_dependence='correlation', nsamples=x_train.shape[0])
-        shap_values = explainer.shap_values(x_test)
 
-        # Linear regression
-        explainer_lin = shap.LinearExplainer(model_lin, x_train, feature_dependence='correlation',
-                                             nsamples=x_train.shape[0])
-        shap_values_lin = explainer_lin.shap_values(x_test)
-
-        # Append prediction
-        all_shap_values.append(shap_values)
-        all_shap_values_lin.append(shap_values_lin)
-
-    # Combine shap values and plot the summary
-    all_shap_values = np.vstack(all_shap_values)
-    all_shap_values_lin = np.vstack(all_shap_values_lin)
-
-    # Inverse PCA for the model without PCA
-    if not mod_coefs:
-        all_shap_values = pca.inverse_transform(all_shap_values)
-        all_shap_values_lin = pca.inverse_transform(all_shap_values_lin)
-
-    # Force plot
-    # shap.force_plot(explainer.expected_value, all_shap_values, features)
-    # plt.show()
-
-    # Summary plots
-    shap.summary_plot(all_shap_values, features, show=False, feature_names=feature_names)
-    # plt.title(f'Logistic Regression ({grade_name})')
-    if savepath is not None:
-        plt.savefig(f'{savepath}{grade_name}_logistic_cov.png', transparent=False, bbox_inches='tight')
-        plt.show()
-    else:
-        plt.show()
-    shap.summary_plot(all_shap_values_lin, features, show=False, feature_names=feature_names)
-    # plt.title(f'Linear Ridge Regression ({grade_name})')
-    if savepath is not None:
-        plt.savefig(f'{savepath}{grade_name}_linear_cov.png', transparent=False, bbox_inches='tight')
-        plt.show()
-    else:
-        plt.show()
-
-
-def scikit_pca(features, n_components, whitening=False, solver='full', seed=42):
+def scikit_pca(features, n_components, whitening=False, solver='full', seed=42, batch_size=500):
     """Calculates dimensionality reduction for input features to given number of PCA components.
 
     Parameters
@@ -510,15 +759,101 @@ def scikit_pca(features, n_components, whitening=False, solver='full', seed=42):
         Random seed used in the PCA.
     solver : str
         Solver for singular value decomposition. Defaults to full solve, possibility for auto, arpack or randomized.
+        With incremental, PCA is fitted in batches (see streaming_pca).
+    batch_size : int
+        Number of samples in a batch for incremental solver.
     Returns
     -------
     PCA object containing all calculated properties, features with dimensionality reduction.
     """
+    if solver == 'incremental':
+        pca = streaming_pca(array_batches(features, batch_size), n_components, whitening=whitening,
+                            batch_size=batch_size)
+        score = np.concatenate([pca.transform(batch) for batch in array_batches(features, batch_size)])
+        return pca, score
+
     pca = PCA(n_components=n_components, svd_solver=solver, whiten=whitening, random_state=seed)
     score = pca.fit(features).transform(features)
     return pca, score
 
 
+def streaming_pca(batches, n_components, whitening=False, batch_size=500):
+    """Fits PCA batch by batch, so that the whole feature matrix does not need to be in memory.
+
+    All components are updated incrementally, which is exact, and truncated to n_components after fitting.
+    Peak memory depends only on the batch size and number of features. Batches are combined or split to
+    batch_size samples, since incremental PCA requires at least as many samples per batch as there are features.
+
+    Parameters
+    ----------
+    batches : iterable
+        Feature batches (samples x features), for example array_batches of a memory mapped array.
+    n_components : int or float
+        Number of output PCA components. If < 1, this is the explained variance of output PCA components.
+    whitening : bool
+        Choice whether to whiten the output PCA components.
+    batch_size : int
+        Number of samples used in each partial fit.
+    Returns
+    -------
+    Fitted IncrementalPCA object. Transform features with pca.transform, for example batch by batch.
+    """
+    pca = IncrementalPCA(n_components=None, whiten=whitening)
+    for batch in rebatch(batches, batch_size):
+        pca.partial_fit(batch)
+
+    # Number of components (from explained variance if n_components < 1)
+    if n_components < 1:
+        n = np.searchsorted(np.cumsum(pca.explained_variance_ratio_), n_components, side='right') + 1
+    else:
+        n = int(n_components)
+    n = min(n, len(pca.explained_variance_ratio_))
+    pca.noise_variance_ = pca.explained_variance_[n:].mean() if n < len(pca.explained_variance_) else 0.0
+    pca.components_ = pca.components_[:n]
+    pca.explained_variance_ = pca.explained_variance_[:n]
+    pca.explained_variance_ratio_ = pca.explained_variance_ratio_[:n]
+    pca.singular_values_ = pca.singular_values_[:n]
+    pca.n_components_ = n
+    return pca
+
+
+def array_batches(features, batch_size=500):
+    """Yields batches of rows of an array. Memory mapped arrays (np.load(mmap_mode='r')) are read batch by batch."""
+    for start in range(0, features.shape[0], batch_size):
+        yield np.asarray(features[start:start + batch_size], dtype=np.float64)
+
+
+def rebatch(batches, batch_size):
+    """Combines and splits batches into batches of at least batch_size samples.
+
+    Last batch contains the remaining samples (less than 2 * batch_size), so that no batch is smaller than
+    batch_size unless there are less samples in total. Large batches are split into views, only samples left
+    over from the previous batch are copied.
+    """
+    full, rest = None, None  # Last full batch is held back, since the remaining samples are appended to it
+    for batch in batches:
+        chunks = []
+        if rest is not None:
+            # Fill the samples left over from the previous batch
+            need = batch_size - rest.shape[0]
+            rest, batch = np.concatenate((rest, batch[:need])), batch[need:]
+            if rest.shape[0] < batch_size:
+                continue
+            chunks.append(rest)
+        n_full = batch.shape[0] // batch_size
+        chunks.extend(batch[k * batch_size:(k + 1) * batch_size] for k in range(n_full))
+        rest = batch[n_full * batch_size:] if batch.shape[0] > n_full * batch_size else None
+        for chunk in chunks:
+            if full is not None:
+                yield full
+            full = chunk
+
+    if full is not None and rest is not None:
+        yield np.concatenate((full, rest))
+    elif full is not None or rest is not None:
+        yield full if full is not None else rest
+
+
 def standardize(array, axis=0):
     """Standardization by mean and standard deviation.
 
@@ -547,55 +882,33 @@ def get_pca(features, n_components):
     Parameters
     ----------
     features : ndarray
-        Input features requiring dimensionality reduction.
+        Input features requiring dimensionality reduction (variables x observations).
     n_components : int
         Number of output PCA components.
 
     Returns
     -------
-    Eigenvectors, dimensionality reduced features.
+    Eigenvectors (variables x components), dimensionality reduced features (observations x components).
     """
     # Feature dimension, x=num variables,n=num observations
     x, n = np.shape(features)
-    # Mean feature
-    mean_f = np.mean(features, axis=1)
     # Centering
-    centered = np.zeros((x, n))
-    for k in range(n):
-        centered[:, k] = features[:, k]-mean_f
+    centered = features - np.mean(features, axis=1, keepdims=True)
 
     # PCs from covariance matrix if n>=x, svd otherwise
     if n >= x:
         # Covariance matrix
-        cov = np.zeros((x, x))
-        f = np.zeros((x, 1))
-        for k in range(n):
-            f[:, 0] = centered[:, k]
-            cov = cov+1/n*np.matmul(f, f.T)
-
-        # Eigenvalues
-        e, v = np.linalg.eig(cov)
-        # Sort eigenvalues and vectors to descending order
-        idx = np.argsort(e)[::-1]
-        v = np.matrix(v[:, idx])
-
-        for k in range(n_components):
-            s = np.matmul(v[:, k].T, centered).T
-            try:
-                score = np.concatenate((score, s), axis=1)
-            except NameError:
-                score = s
-            p = v[:, k]
-            try:
-                n_components = np.concatenate((n_components, p), axis=1)
-            except NameError:
-                n_components = p
+        cov = np.matmul(centered, centered.T) / n
+
+        # Eigenvalues of symmetric matrix, sorted to descending order
+        e, v = np.linalg.eigh(cov)
+        eigenvectors = v[:, np.argsort(e)[::-1][:n_components]]
     else:
         # PCA with SVD
-        u, s, v = np.linalg.svd(centered, compute_uv=1)
-        n_components = v[:, :n_components]
-        score = np.matmul(u, s).T[:, 1:n_components]
-    return n_components, score
+        u, _, _ = np.linalg.svd(centered, full_matrices=False)
+        eigenvectors = u[:, :n_components]
+    score = np.matmul(eigenvectors.T, centered).T
+    return eigenvectors, score
 
 
 def evaluate_model(features, args, model_path):
@@ -613,28 +926,90 @@ def evaluate_model(features, args, model_path):
     -------
     Linear predictions, logistic predicitons, PCA components.
     """
-    # Load model
-
-    _, n_comp, eigen_vectors, sv_scaled, weights, weights_log, mean_feature, [intercept_lin, intercept_log] \
-        = load_binary_weights(model_path)
+    return compiled_model(model_path, args).predict(features)
 
-    # Standardize features
-    if args.standardization == 'centering':
-        mean = np.mean(features, 1)
-        features = features.T - mean
-        # features = features.T - mean_feature
-    else:
-        features = standardize(features.T, axis=0)
 
-    # PCA
-    if args.use_PCA:
-        score = np.matmul(features, eigen_vectors / sv_scaled)
-    else:
-        score = features
+class CompiledModel(object):
+    """Saved PCA + regression model compiled for inference.
 
-    # Regression
-    pred_linear = np.matmul(score, weights) + intercept_lin
-    pred_logistic = np.matmul(score, weights_log) + intercept_log
-    pred_logistic = (1 + np.exp(-pred_logistic)) ** -1
+    PCA projection (eigenvectors / singular values) and both regression heads are multiplied into a single
+    (features x 2) matrix and bias, so that predictions need one matrix product. Features are centered
+    (or standardized) with the statistics of the evaluated batch, as in training.
 
-    return pred_linear, pred_logistic, score
\ No newline at end of file
+    Parameters
+    ----------
+    path : str
+        Path to saved model (see load_binary_weights).
+    standardization : str
+        Centering or centering and standardization of features.
+    use_PCA : bool
+        Choice whether the model uses dimensionality reduction.
+    """
+    def __init__(self, path, standardization='centering', use_PCA=True):
+        _, n_comp, eigen_vectors, sv_scaled, weights, weights_log, mean_feature, intercepts \
+            = load_binary_weights(path)
+        self.standardization = standardization
+        self.n_components = n_comp
+
+        # PCA projection
+        if use_PCA:
+            self.projection = eigen_vectors / sv_scaled
+        else:
+            self.projection = np.eye(len(weights))
+
+        # Linear and logistic heads
+        self.matrix = np.matmul(self.projection, np.stack((weights, weights_log), axis=1))
+        self.bias = np.array(intercepts)
+
+    def predict(self, features):
+        """Returns linear predictions, logistic predictions and PCA components of features (features x samples)."""
+        features = self._standardize(features.T[np.newaxis])[0]
+        return self._predict(features)
+
+    def predict_batch(self, features, subvolume_index, combiner=np.mean):
+        """Predicts all subvolumes at once and combines the predictions of each sample.
+
+        Parameters
+        ----------
+        features : ndarray
+            Features of all subvolumes (features x samples). Each subvolume contains the same samples in the same order.
+        subvolume_index : ndarray
+            Subvolume of each column in features.
+        combiner : function
+            Method to combine predictions of subvolumes, called with axis=0 (e.g. np.mean, np.max, np.median).
+        Returns
+        -------
+        Combined linear predictions, logistic predictions and PCA components.
+        """
+        subvolume_index = np.asarray(subvolume_index)
+        n_subvolumes = len(np.unique(subvolume_index))
+
+        # Subvolumes x samples x features
+        order = np.argsort(subvolume_index, kind='stable')
+        features = features[:, order].T.reshape(n_subvolumes, -1, features.shape[0])
+        features = self._standardize(features)
+
+        pred_linear, pred_logistic, score = self._predict(features)
+        return combiner(pred_linear, axis=0), combiner(pred_logistic, axis=0), combiner(score, axis=0)
+
+    def _standardize(self, features):
+        """Centers or standardizes each batch (batches x samples x features) with its own statistics."""
+        if self.standardization == 'centering':
+            return features - np.mean(features, axis=1, keepdims=True)
+        return (features - np.mean(features, axis=1, keepdims=True)) / np.std(features, axis=1, keepdims=True)
+
+    def _predict(self, features):
+        predictions = np.matmul(features, self.matrix) + self.bias
+        pred_logistic = (1 + np.exp(-predictions[..., 1])) ** -1
+        return predictions[..., 0], pred_logistic, np.matmul(features, self.projection)
+
+
+_compiled_models = {}
+
+
+def compiled_model(path, args):
+    """Returns CompiledModel of a saved model. Models are loaded once and reloaded only if the file changes."""
+    key = (os.path.abspath(path), os.path.getmtime(path), args.standardization, args.use_PCA)
+    if key not in _compiled_models:
+        _compiled_models[key] = CompiledModel(path, standardization=args.standardization, use_PCA=args.use_PCA)
+    return _compiled_models[key]
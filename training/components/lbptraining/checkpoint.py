@@ -0,0 +1,60 @@
+"""Contains checkpointing for long parameter optimization runs."""
+
+import os
+import pickle
+import tempfile
+
+
+class Checkpoint(object):
+    """Directory of pickled optimization states that can be resumed after interruption.
+
+    Each state is stored in its own file (e.g. one per LOO fold), so that parallel workers do not write to the same
+    file. Files are written to a temporary file and moved in place, so an interrupted write never corrupts
+    a previous state.
+
+    Parameters
+    ----------
+    path : str
+        Checkpoint directory. Created if it does not exist.
+    resume : bool
+        Choice whether to load existing states. If False, states are only written.
+    every : int
+        Saving interval (e.g. number of evaluations) used by the optimization functions.
+    """
+    def __init__(self, path, resume=True, every=10):
+        self.path = path
+        self.resume = resume
+        self.every = every
+        os.makedirs(path, exist_ok=True)
+
+    def load(self, name):
+        """Returns saved state or None if it is not found or resume is not used."""
+        if not self.resume:
+            return None
+        try:
+            with open(self._file(name), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, name, state):
+        """Saves state atomically."""
+        handle, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, self._file(name))
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.pkl')
+
+
+def checkpoint(args):
+    """Returns Checkpoint from grading arguments or None if checkpointing is not used."""
+    if getattr(args, 'checkpoint', None) is None:
+        return None
+    return Checkpoint(args.checkpoint, resume=args.resume, every=args.checkpoint_every)
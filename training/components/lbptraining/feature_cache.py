@@ -0,0 +1,159 @@
+"""Contains an on-disk cache for MRELBP features used in parameter optimization."""
+
+import numpy as np
+import os
+import json
+import hashlib
+import tempfile
+
+
+class FeatureCache(object):
+    """Persistent feature cache addressed by image content and MRELBP parameters.
+
+    Features are stored as .npy files named by a hash of the image digest (see image_digest), canonicalized
+    parameters and feature options. Files are written to a temporary file and moved in place, so that joblib workers
+    sharing the directory never read partially written features. Least recently used files are removed
+    when the size of the cache exceeds max_size.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory. Created if it does not exist.
+    max_size : int
+        Approximate maximum size of the cache in bytes.
+    """
+    def __init__(self, path, max_size=2 ** 30):
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, image, parameters, digest=None, **options):
+        """Returns cache key of an image and parameter dictionary.
+
+        Parameter 'seed' is ignored, since it does not affect the features.
+        Additional options (e.g. normalization method) are included in the key.
+        Image digest can be given, so that the image is not hashed again for each parameter set.
+        """
+        if digest is None:
+            digest = image_digest(image)
+        return hashlib.sha1((digest + parameter_key(parameters, **options)).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns cached features or None if the key is not found."""
+        file = self._file(key)
+        try:
+            features = np.load(file)
+            os.utime(file)  # Mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return features
+
+    def put(self, key, features):
+        """Writes features to the cache and removes old files if the cache is full."""
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(file), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, np.asarray(features))
+            os.replace(temp, file)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._files())
+        else:
+            self._size += os.path.getsize(file)
+        if self._size > self.max_size:
+            self.evict()
+
+    def features(self, image, parameters, compute, digest=None, **options):
+        """Returns cached features or calculates them with compute(image, parameters) and stores the result."""
+        key = self.key(image, parameters, digest=digest, **options)
+        features = self.get(key)
+        if features is None:
+            features = compute(image, parameters)
+            self.put(key, features)
+        return features
+
+    def evict(self, fraction=0.9):
+        """Removes least recently used files until the cache is below fraction of max_size."""
+        files = sorted(self._files(), key=lambda f: f[2])
+        size = sum(f[1] for f in files)
+        for file, file_size, _ in files:
+            if size <= self.max_size * fraction:
+                break
+            try:
+                os.remove(file)
+            except OSError:  # Removed by another worker
+                pass
+            size -= file_size
+        self._size = size
+
+    def clear(self):
+        """Removes all cached features."""
+        for file, _, _ in self._files():
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+        self._size = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.npy')
+
+    def _files(self):
+        """Cached files as (path, size, modification time)."""
+        files = []
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith('.npy'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((os.path.join(root, name), stat.st_size, stat.st_mtime))
+        return files
+
+
+def feature_cache(args):
+    """Returns FeatureCache from grading arguments or None if caching is not used."""
+    if getattr(args, 'feature_cache', None) is None:
+        return None
+    return FeatureCache(args.feature_cache, args.feature_cache_size)
+
+
+def image_digest(image):
+    """Returns hash of image bytes, shape and data type."""
+    image = np.ascontiguousarray(image)
+    content = hashlib.sha1(image.tobytes())
+    content.update(str((image.shape, image.dtype.str)).encode())
+    return content.hexdigest()
+
+
+def image_digests(imgs, args):
+    """Returns digests of images for feature cache keys, or None if caching is not used.
+    Images are hashed once per search instead of once per parameter set."""
+    if getattr(args, 'feature_cache', None) is None:
+        return None
+    return [image_digest(img) for img in imgs]
+
+
+def parameter_key(parameters, **options):
+    """Returns canonical JSON string of MRELBP parameters and feature options. Parameter 'seed' is ignored."""
+    pars = {k: _canonical(v) for k, v in parameters.items() if k != 'seed'}
+    pars.update({k: _canonical(v) for k, v in options.items()})
+    return json.dumps(pars, sort_keys=True)
+
+
+def _canonical(value):
+    """Converts numpy scalars to python numbers, so that equal parameters give equal keys."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
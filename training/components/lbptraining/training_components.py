@@ -1,15 +1,23 @@
 import numpy as np
+import copy
+import shutil
+import tempfile
 
-from joblib import Parallel, delayed
+from time import time
+from joblib import Parallel, delayed, effective_n_jobs
 from tqdm import tqdm
 from functools import partial
 from hyperopt import hp, fmin, tpe, STATUS_OK, Trials, space_eval
+from hyperopt.base import Domain, JOB_STATE_NEW, JOB_STATE_DONE, spec_from_misc
+from hyperopt.fmin import generate_trials_to_calculate
 
 from sklearn.model_selection import LeaveOneOut, LeaveOneGroupOut
 from sklearn.metrics import mean_squared_error
 
-from components.grading.local_binary_pattern import local_normalize_abs, MRELBP
+from components.grading.local_binary_pattern import MRELBP_multi, worker_threads
 from components.grading.pca_regression import scikit_pca, regress_logo, regress_loo, standardize, logistic_logo
+from components.lbptraining.feature_cache import feature_cache, parameter_key, image_digests
+from components.lbptraining.checkpoint import checkpoint
 
 
 def make_pars(n_pars):
@@ -53,16 +61,135 @@ def make_pars_hyperopt(seed):
     return par_set
 
 
-def fit_model(imgs, grades, parameters, args, loss=mean_squared_error, groups=None):
-    """Runs MRELBP, PCA and regression on given parameters and returns error metric."""
-    
-    # LBP features
-    features = []
-    for img in imgs:
-        img = local_normalize_abs(img, parameters)
-        f = MRELBP(img, parameters, args=args, normalize=args.normalize_hist)
-        features.append(f)
-    features = np.array(features).squeeze()
+def fit_models(imgs, grades, parameter_list, args, loss=mean_squared_error, groups=None, median_threads=1,
+               digests=None):
+    """Runs MRELBP, PCA and regression on a list of parameter sets and returns error metric for each set.
+
+    Local normalization and median filtering are shared between parameter sets using the same kernels.
+    Results are equal to calculating MRELBP and regression_loss separately for each parameter set.
+    """
+    features = lbp_features(imgs, parameter_list, args, median_threads=median_threads, digests=digests)
+
+    errors = []
+    for k in range(len(parameter_list)):
+        try:
+            errors.append(regression_loss(features[k], grades, args, loss=loss, groups=groups))
+        except TypeError:
+            errors.append(1e6)
+    return errors
+
+
+def fit_models_folds(imgs, grades, parameter_list, folds, args, loss=mean_squared_error, groups=None,
+                     median_threads=1, digests=None):
+    """Runs MRELBP on all images once per parameter set and returns error metric of each training fold.
+
+    Features of each image depend only on the image and parameters, so training fold features are obtained
+    by indexing rows of the full feature matrix. Results are equal to featurizing the images of each fold.
+
+    Parameters
+    ----------
+    imgs : ndarray
+        All input images.
+    grades : ndarray
+        Ground truth for all images.
+    parameter_list : list
+        List of parameter sets.
+    folds : list
+        Training indices of each fold.
+    args : Namespace
+        Grading arguments.
+    loss : function
+        Loss function used in optimization.
+    groups : ndarray
+        Patient groups for all images.
+    median_threads : int
+        Number of threads used by exact median filtering.
+    digests : list
+        Image digests used in feature cache keys (see image_digests).
+    Returns
+    -------
+    Errors with shape (n_pars, n_folds).
+    """
+    features = lbp_features(imgs, parameter_list, args, median_threads=median_threads, digests=digests)
+
+    errors = np.zeros((len(parameter_list), len(folds)))
+    for k in range(len(parameter_list)):
+        for i, train_idx in enumerate(folds):
+            errors[k, i] = fold_loss(features[k], grades, train_idx, args, loss=loss, groups=groups)
+    return errors
+
+
+def fold_loss(features, grades, train_idx, args, loss=mean_squared_error, groups=None):
+    """Returns error metric of regression_loss on training fold rows of a full feature matrix."""
+    groups_train = groups[train_idx] if groups is not None else None
+    try:
+        return regression_loss(features[train_idx], grades[train_idx], args, loss=loss, groups=groups_train)
+    except TypeError:
+        return 1e6
+
+
+def lbp_features(imgs, parameter_list, args, median_threads=1, digests=None):
+    """Calculates MRELBP features of all images for a list of parameter sets.
+
+    Uses feature cache if given in arguments (see feature_cache). Digests of the images (see image_digests)
+    can be given, so that images are not hashed again for each call.
+    Median filtering uses median_threads threads, which should be 1 inside parallel workers.
+
+    Returns
+    -------
+    Features with shape (n_pars, n_images, 32).
+    """
+    def compute(img, pars):
+        return MRELBP_multi(img, pars, normalize=args.normalize_hist, method=args.normalization,
+                            median_method=args.median_method, median_threads=median_threads)
+
+    # LBP features, shape (n_images, n_pars, 32)
+    cache = feature_cache(args)
+    if cache is None:
+        features = np.array([compute(img, parameter_list) for img in imgs])
+    else:
+        features = []
+        for i, img in enumerate(imgs):
+            # Calculate only parameter sets missing from the cache
+            digest = digests[i] if digests is not None else None
+            keys = [cache.key(img, pars, digest=digest, **feature_options(args)) for pars in parameter_list]
+            f = [cache.get(key) for key in keys]
+            missing = [k for k in range(len(f)) if f[k] is None]
+            if len(missing) > 0:
+                computed = compute(img, [parameter_list[k] for k in missing])
+                for k, feature in zip(missing, computed):
+                    f[k] = feature.reshape(1, -1)
+                    cache.put(keys[k], f[k])
+            features.append(np.concatenate(f, 0))
+        features = np.array(features)
+    return features.transpose(1, 0, 2)
+
+
+def group_parameters(parameter_list):
+    """Returns indices of parameter sets grouped by local normalization kernels, in order of first occurrence.
+
+    Each group is calculated with one MRELBP_multi call, which normalizes each image only once per group
+    and shares median filtered images between parameter sets with equal median kernel sizes.
+    """
+    groups = dict()
+    for i, p in enumerate(parameter_list):
+        groups.setdefault((p['ks1'], p['sigma1'], p['ks2'], p['sigma2']), []).append(i)
+    return list(groups.values())
+
+
+def parameter_batches(parameter_list, n_jobs):
+    """Splits parameter groups (see group_parameters) into batches of n_jobs groups, one group per worker."""
+    groups = group_parameters(parameter_list)
+    return [groups[k:k + n_jobs] for k in range(0, len(groups), n_jobs)]
+
+
+def feature_options(args):
+    """Feature calculation options that are included in feature cache keys in addition to the parameters."""
+    return dict(normalize=args.normalize_hist, normalization=args.normalization, median_method=args.median_method)
+
+
+def standardize_features(features, args):
+    """Removes zero features and centers or standardizes calculated MRELBP features."""
     # Remove zero features
     features = features[~np.all(features == 0, axis=1)]
 
@@ -72,10 +199,17 @@ def fit_model(imgs, grades, parameters, args, loss=mean_squared_error, groups=No
         features = (features.T - mean).T
     else:
         features = standardize(features.T, axis=0).T
+    return features
+
+
+def regression_loss(features, grades, args, loss=mean_squared_error, groups=None):
+    """Runs PCA and regression on calculated MRELBP features and returns error metric."""
+    features = standardize_features(features, args)
 
     # PCA
     if args.use_PCA:
-        _, score = scikit_pca(features, args.n_components, whitening=True, solver='auto')
+        _, score = scikit_pca(features, args.n_components, whitening=True, solver=args.pca_solver,
+                              batch_size=args.pca_batch_size)
     else:
         score = features
 
@@ -91,13 +225,192 @@ def fit_model(imgs, grades, parameters, args, loss=mean_squared_error, groups=No
     return loss(preds, grades)
 
 
-def evaluate(parameters, imgs, grades, args, loss, groups=None):
+def evaluate_fold(parameters, imgs, grades, train_idx, args, loss, groups=None, memo=None, median_threads=1,
+                  digests=None):
+    """Hyperopt objective for a training fold. Features of all images are calculated once per parameter set
+    and stored in memo, so that the same parameters are not featurized again in other folds."""
+    key = parameter_key(parameters)
+    if memo is None or key not in memo:
+        features = lbp_features(imgs, [parameters], args, median_threads=median_threads, digests=digests)[0]
+        if memo is not None:
+            memo[key] = features
+    else:
+        features = memo[key]
+    res = fold_loss(features, grades, train_idx, args, loss=loss, groups=groups)
+    return {'loss': res, 'status': STATUS_OK}
+
+
+def evaluate_batch(parameter_list, imgs, grades, train_idx, args, loss, groups=None, memo=None, n_jobs=1,
+                   median_threads=1, digests=None):
+    """Hyperopt objective for a batch of parameter sets. Features of parameter sets missing from memo
+    are calculated in parallel, after which fold losses are evaluated as in evaluate_fold.
+    The median_threads threads are shared by the parallel workers."""
+    if memo is None:
+        memo = dict()
+    keys = [parameter_key(parameters) for parameters in parameter_list]
+    missing = [k for k in range(len(keys)) if keys[k] not in memo and keys[k] not in keys[:k]]
+
+    tasks = [[missing[i] for i in group] for group in group_parameters([parameter_list[k] for k in missing])]
+    threads = max(1, median_threads // max(1, min(n_jobs, len(tasks))))
+    features = Parallel(n_jobs=n_jobs)(delayed(lbp_features)(imgs, [parameter_list[k] for k in task], args,
+                                                             median_threads=threads, digests=digests)
+                                       for task in tasks)
+    for task, f in zip(tasks, features):
+        for k, feature in zip(task, f):
+            memo[keys[k]] = feature
+
+    return [{'loss': fold_loss(memo[key], grades, train_idx, args, loss=loss, groups=groups), 'status': STATUS_OK}
+            for key in keys]
+
+
+def fmin_parallel(fn, space, max_evals, trials, rstate, batch_size):
+    """Minimizes fn with tree of Parzen estimators, evaluating batches of suggestions concurrently.
+
+    Each batch is suggested with the constant liar strategy: suggestions are added one at a time
+    as finished trials with the best loss so far, so that TPE does not propose the same point again.
+    Liar losses are replaced with the evaluated losses before the next batch. Suggestion seeds are drawn from rstate,
+    so results are reproducible for a fixed seed and batch size (but differ from sequential fmin).
+    Queued trials (e.g. from generate_trials_to_calculate) are evaluated as the first batch.
+
+    Parameters
+    ----------
+    fn : function
+        Batch objective. Called with a list of parameter sets, returns a list of hyperopt results.
+    space : dict
+        Hyperopt search space.
+    max_evals : int
+        Number of evaluated parameter sets.
+    trials : Trials
+        Hyperopt trials object. Evaluated trials are stored here.
+    rstate : RandomState
+        Random state for suggestions.
+    batch_size : int
+        Number of parameter sets evaluated concurrently.
+    Returns
+    -------
+    Best point (as returned by fmin).
+    """
+    domain = Domain(fn, space)
+
+    # Queued points
+    pending = [trial for trial in trials._dynamic_trials if trial['state'] == JOB_STATE_NEW]
+    if len(pending) > 0:
+        results = fn([space_eval(space, spec_from_misc(trial['misc'])) for trial in pending])
+        for trial, result in zip(pending, results):
+            trial['state'] = JOB_STATE_DONE
+            trial['result'] = result
+        trials.refresh()
+
+    while len(trials.trials) < max_evals:
+        losses = [l for l in trials.losses() if l is not None]
+        liar = min(losses) if len(losses) > 0 else 0.0
+
+        # Constant liar suggestions
+        tids = []
+        for _ in range(min(batch_size, max_evals - len(trials.trials))):
+            new_ids = trials.new_trial_ids(1)
+            trials.refresh()
+            docs = tpe.suggest(new_ids, domain, trials, rstate.randint(2 ** 31 - 1))
+            for doc in docs:
+                doc['state'] = JOB_STATE_DONE
+                doc['result'] = {'loss': liar, 'status': STATUS_OK}
+            trials.insert_trial_docs(docs)
+            trials.refresh()
+            tids.extend(new_ids)
+
+        # Evaluate batch
+        pending = [trial for trial in trials._dynamic_trials if trial['tid'] in tids]
+        results = fn([space_eval(space, spec_from_misc(trial['misc'])) for trial in pending])
+        for trial, result in zip(pending, results):
+            trial['result'] = result
+        trials.refresh()
+
+    return trials.argmin
+
+
+def _optimize_fold(train_idx, imgs, grades, args, loss, groups=None, memo=None, fold=0, seed_points=None,
+                   median_threads=1, digests=None):
+    """Runs hyperopt on one training fold.
+
+    If checkpointing is used (see checkpoint), trials and random state are saved every
+    args.checkpoint_every evaluations, and a resumed run continues from the saved trials.
+    Finished folds are not optimized again.
+
+    If seed points are given (warm start), they are evaluated on this fold first and
+    args.warm_start_evals new points are suggested after them instead of args.n_pars.
+
+    Messages are returned instead of printed, so that the parent process can log folds run in joblib workers.
+
+    Returns
+    -------
+    Fold index, best point (None if optimization fails), trials, elapsed time and list of messages.
+    """
+    start_time = time()
+    ckpt = checkpoint(args)
+    name = 'hyperopt_fold_{0}'.format(fold)
+
+    messages = []
+
+    # Saved state
+    state = ckpt.load(name) if ckpt is not None else None
+    if state is not None and state['done']:
+        messages.append('Fold {0} loaded from checkpoint'.format(fold + 1))
+        return fold, state['min_loss'], state['trials'], state['elapsed'], messages
+    elif state is not None:
+        messages.append('Resuming fold {0} from {1} trials'.format(fold + 1, len(state['trials'].trials)))
+        trials, rstate, elapsed, n_evals = state['trials'], state['rstate'], state['elapsed'], state['n_evals']
+    elif seed_points:
+        # Warm start, previous points are scored again on this fold
+        trials, rstate, elapsed = generate_trials_to_calculate(seed_points), np.random.RandomState(args.seed), 0
+        trials.refresh()
+        n_evals = len(seed_points) + max(1, args.warm_start_evals)
+    else:
+        # Initialize
+        trials, rstate, elapsed, n_evals = Trials(), np.random.RandomState(args.seed), 0, args.n_pars
+
     try:
-        res = fit_model(imgs, grades, parameters, args, loss, groups=groups)
+        # Define param space
+        param_space = make_pars_hyperopt(args.seed)
+
+        # Optimize, in chunks of checkpoint_every evaluations if checkpoints are saved
+        min_loss = trials.argmin if len(trials.losses()) > 0 and trials.losses()[0] is not None else None
+        while len(trials.trials) < n_evals:
+            if ckpt is not None:
+                max_evals = min(n_evals, len(trials.trials) + ckpt.every)
+            else:
+                max_evals = n_evals
+            if args.hyperopt_jobs > 1:
+                min_loss = fmin_parallel(partial(evaluate_batch, imgs=imgs, grades=grades, train_idx=train_idx,
+                                                 args=args, groups=groups, loss=loss, memo=memo,
+                                                 n_jobs=args.hyperopt_jobs, median_threads=median_threads,
+                                                 digests=digests),
+                                         space=param_space,
+                                         max_evals=max_evals,
+                                         trials=trials,
+                                         rstate=rstate,
+                                         batch_size=args.hyperopt_jobs)
+            else:
+                min_loss = fmin(fn=partial(evaluate_fold, imgs=imgs, grades=grades, train_idx=train_idx, args=args,
+                                groups=groups, loss=loss, memo=memo, median_threads=median_threads,
+                                digests=digests),
+                                space=param_space,
+                                algo=tpe.suggest,
+                                max_evals=max_evals,
+                                trials=trials,
+                                verbose=0,
+                                rstate=rstate)
+            if ckpt is not None and len(trials.trials) < n_evals:
+                ckpt.save(name, dict(trials=trials, rstate=rstate, min_loss=min_loss, done=False, n_evals=n_evals,
+                                     elapsed=elapsed + time() - start_time))
     except TypeError:
-        res = 1e6
-    # print('Parameters are: {0}'.format(parameters))
-    return {'loss': res, 'status': STATUS_OK}  # , 'pars': parameters}
+        return fold, None, None, elapsed + time() - start_time, messages
+
+    elapsed += time() - start_time
+    if ckpt is not None:
+        ckpt.save(name, dict(trials=trials, rstate=rstate, min_loss=min_loss, done=True, n_evals=n_evals,
+                             elapsed=elapsed))
+
+    return fold, min_loss, trials, elapsed, messages
 
 
 def optimization_hyperopt_loo(imgs, grades, args, loss, groups=None):
@@ -112,6 +425,17 @@ def optimization_hyperopt_loo(imgs, grades, args, loss, groups=None):
         Ground truth
     args : Namespace
         Contains arguments for grading pipeline. See grading_pipelines for description.
+        hyperopt_jobs = Number of concurrent trial evaluations. Values > 1 use constant liar TPE (see fmin_parallel).
+        fold_jobs = Maximum number of folds optimized in parallel. Sequential folds (1) share features in memory.
+            Fold workers are limited to n_jobs // hyperopt_jobs, since each fold uses hyperopt_jobs workers.
+            Parallel folds share features through the feature cache (a temporary directory if feature_cache is None).
+        checkpoint = Directory for saving optimization state (None to disable). See _optimize_fold.
+        resume = Choice whether to continue from saved state.
+        warm_start_points = Number of best points from the previous fold evaluated first in the next fold (0 to disable).
+            Seed points are scored from memoized features. With parallel folds, all folds are warm started
+            from the first fold, and its features of the seed points are passed to the workers.
+        warm_start_evals = Number of new evaluations in warm started folds.
+        convergence_step = Interval of printed convergence curves.
     loss : funciton
         Loss function used in optimization. (e.g. mean squared error)
     groups : ndarray
@@ -123,43 +447,63 @@ def optimization_hyperopt_loo(imgs, grades, args, loss, groups=None):
     # Get leave-one-out split
     loo = LeaveOneOut()
     loo.get_n_splits(grades)
+    folds = [train_idx for train_idx, _ in loo.split(grades)]
+
+    # Fold workers, each fold uses hyperopt_jobs workers of the n_jobs budget
+    fold_jobs = min(max(1, effective_n_jobs(args.n_jobs) // max(1, args.hyperopt_jobs)), args.fold_jobs, len(folds))
+
+    print('\nOptimizing through sets')
+    memo = dict()  # Features of all images for evaluated parameter sets
+    warm_start = args.warm_start_points > 0
+    if fold_jobs > 1:
+        print('Optimizing {0} folds with {1} workers'.format(len(folds), fold_jobs))
+        # Workers do not share memo, features are shared through the feature cache
+        temp_cache = None
+        if args.feature_cache is None:
+            args = copy.copy(args)
+            args.feature_cache = temp_cache = tempfile.mkdtemp(prefix='feature_cache_')
+        try:
+            results, seed_points, seed_memo = dict(), None, dict()
+            digests = image_digests(imgs, args)
+            if warm_start:
+                # First fold is optimized alone and used to warm start the others
+                results[0] = report_fold(_optimize_fold(folds[0], imgs, grades, args, loss, groups, memo=memo, fold=0,
+                                                        median_threads=worker_threads(args), digests=digests),
+                                         len(folds), args)
+                seed_points = best_points(results[0][1], args.warm_start_points)
+                seed_memo = seed_features(seed_points, memo, args)
+            # Folds are reported as they finish
+            for result in Parallel(n_jobs=fold_jobs, return_as='generator_unordered')(
+                    delayed(_optimize_fold)(train_idx, imgs, grades, args, loss, groups, memo=dict(seed_memo),
+                                            fold=fold, seed_points=seed_points,
+                                            median_threads=worker_threads(args, fold_jobs), digests=digests)
+                    for fold, train_idx in enumerate(folds) if fold not in results):
+                results[result[0]] = report_fold(result, len(folds), args)
+        finally:
+            if temp_cache is not None:
+                shutil.rmtree(temp_cache, ignore_errors=True)
+    else:
+        results, seed_points, digests = dict(), None, image_digests(imgs, args)
+        for fold, train_idx in enumerate(tqdm(folds, desc='Calculating LOO optimization')):
+            results[fold] = report_fold(_optimize_fold(train_idx, imgs, grades, args, loss, groups, memo=memo,
+                                                       fold=fold, seed_points=seed_points,
+                                                       median_threads=worker_threads(args), digests=digests),
+                                        len(folds), args)
+            # Previous fold is used to warm start the next one
+            if warm_start:
+                seed_points = best_points(results[fold][1], args.warm_start_points)
 
     best_pars = []
     trial_list = []
     error_list = []
-    print('\nOptimizing through sets')
-    for train_idx, test_idx in tqdm(loo.split(grades), desc='Calculating LOO optimization'):
-        # Get training set
-        grades_train = grades[train_idx]
-        imgs_train = imgs[train_idx]
-        if groups is not None:
-            groups_train = groups[train_idx]
-        else:
-            groups_train = None
-
-        try:
-            # Initialize, define param space
-            trials = Trials()
-            param_space = make_pars_hyperopt(args.seed)
-
-            # Optimize
-            min_loss = fmin(fn=partial(evaluate, imgs=imgs_train, grades=grades_train, args=args,
-                            groups=groups_train, loss=loss),
-                            space=param_space,
-                            algo=tpe.suggest,
-                            max_evals=args.n_pars,
-                            trials=trials,
-                            verbose=0,
-                            rstate=np.random.RandomState(args.seed))
-
-            print(min_loss)
-            print(space_eval(param_space, min_loss))
-            best_pars.append(space_eval(param_space, min_loss))
-            error_list.append(min_loss)
-            trial_list.append(trials)
-        except TypeError:
-            print('Batch failing. Skipping to next one')
+    param_space = make_pars_hyperopt(args.seed)
+    for fold in range(len(folds)):
+        min_loss, trials = results[fold]
+        if min_loss is None:
             continue
+        best_pars.append(space_eval(param_space, min_loss))
+        error_list.append(min_loss)
+        trial_list.append(trials)
 
     # Show results
     for i in range(len(best_pars)):
@@ -168,6 +512,61 @@ def optimization_hyperopt_loo(imgs, grades, args, loss, groups=None):
     return best_pars, error_list
 
 
+def report_fold(result, n_folds, args):
+    """Prints the messages and results of an optimized fold (see _optimize_fold). Returns best point and trials."""
+    fold, min_loss, trials, elapsed, messages = result
+    for message in messages:
+        print(message)
+    print('Fold {0}/{1} finished in {2:.1f}s'.format(fold + 1, n_folds, elapsed))
+    if min_loss is None:
+        print('Batch failing. Skipping to next one')
+        return min_loss, trials
+    print(min_loss)
+    print(space_eval(make_pars_hyperopt(args.seed), min_loss))
+    print('Convergence (best loss every {0} evaluations): {1}'
+          .format(args.convergence_step, format_curve(convergence_curve(trials), args.convergence_step)))
+    return min_loss, trials
+
+
+def best_points(trials, n_points):
+    """Returns the hyperopt points (label: value) of the n_points best trials. Used to warm start other folds."""
+    if trials is None:
+        return None
+    losses = [np.inf if l is None else l for l in trials.losses()]
+    points = []
+    for i in np.argsort(losses, kind='mergesort'):
+        vals = trials.trials[i]['misc']['vals']
+        point = {label: np.asarray(value[0]).item() for label, value in vals.items() if len(value) > 0}
+        if point not in points:
+            points.append(point)
+        if len(points) == n_points:
+            break
+    return points
+
+
+def seed_features(points, memo, args):
+    """Returns memoized features of hyperopt points (see best_points), keyed as in evaluate_fold."""
+    if points is None:
+        return dict()
+    param_space = make_pars_hyperopt(args.seed)
+    keys = [parameter_key(space_eval(param_space, point)) for point in points]
+    return {key: memo[key] for key in keys if key in memo}
+
+
+def convergence_curve(trials):
+    """Returns the best loss after each evaluation of a hyperopt run."""
+    losses = [np.inf if l is None else l for l in trials.losses()]
+    return np.minimum.accumulate(losses)
+
+
+def format_curve(curve, step=10):
+    """Formats every step:th value and the last value of a convergence curve."""
+    indices = list(range(step - 1, len(curve), step))
+    if len(curve) > 0 and (len(indices) == 0 or indices[-1] != len(curve) - 1):
+        indices.append(len(curve) - 1)
+    return ', '.join('{0}: {1:.4g}'.format(i + 1, curve[i]) for i in indices)
+
+
 def optimization_randomsearch_loo(imgs, grades, args, loss, groups=None):
     """Optimizes hyperparameters for MRELBP and local standardization using random search
     and leave-one-out split for training multiple optimizations.
@@ -190,45 +589,47 @@ def optimization_randomsearch_loo(imgs, grades, args, loss, groups=None):
     """
     # Unpack parameters
     n_pars = args.n_pars
-    n_jobs = args.n_jobs
+    n_jobs = effective_n_jobs(args.n_jobs)
     np.random.seed(args.seed)
     # Create parameter sets
     pars = make_pars(n_pars)
+    batches = parameter_batches(pars, n_jobs)
 
     # Get leave-one-out split
     loo = LeaveOneOut()
     loo.get_n_splits(grades)
+    folds = [train_idx for train_idx, _ in loo.split(grades)]
+
+    # Saved errors
+    ckpt = checkpoint(args)
+    saved = load_search_state(ckpt, 'randomsearch_loo', pars, batches)
+    digests = image_digests(imgs, args)
+
+    # Errors of all folds, features are calculated once per parameter set
+    for k in tqdm(range(len(batches)), desc='Optimizing parameters'):
+        if k >= len(saved):
+            _errors = Parallel(n_jobs=n_jobs)(delayed(fit_models_folds)
+                                              (imgs, grades, [pars[i] for i in task], folds, args, loss, groups,
+                                               median_threads=worker_threads(args, len(batches[k])),
+                                               digests=digests)
+                                              for task in batches[k])
+            saved.append(np.concatenate(_errors))
+            save_search_state(ckpt, 'randomsearch_loo', pars, batches, saved, k + 1)
+
+    # Shape (n_pars, n_folds), in the order of pars
+    errors = np.zeros((len(pars), len(folds)))
+    errors[np.concatenate([np.concatenate(batch) for batch in batches])] = np.concatenate(saved)
 
     best_pars = []
     error_list = []
-    set = 1
-    for train_idx, test_idx in loo.split(grades):
-        min_error = 1e6
-        outpars = pars[0]
-        imgs_train = imgs[train_idx]
-        grades_train = grades[train_idx]
-        groups_train = groups[train_idx]
-
-        for k in tqdm(range(int(len(pars)/n_jobs)+1), desc='Optimizing parameters'):
-            k1 = np.min([k*n_jobs, len(pars)+1])
-            k2 = np.min([(k+1)*n_jobs, len(pars)])
-            if k1 < len(pars):
-                _pars = pars[k1:k2]
-                errors = Parallel(n_jobs=n_jobs)(delayed(fit_model)
-                                                 (imgs_train, grades_train, p, args, loss, groups_train)
-                                                 for p in _pars)
-
-                min_idx = np.argmin(np.array(errors))
-
-                _min_error = errors[min_idx]
-                if _min_error < min_error:
-                    outpars = _pars[min_idx]
-                    min_error = _min_error
-                    print('Current minimum error is: {0}'.format(min_error))
-        print('Best parameters for set {0} are {1}'.format(set, outpars))
+    for fold in range(len(folds)):
+        # First parameter set with minimum error, as in sequential search
+        min_idx = np.argmin(errors[:, fold])
+        outpars = pars[min_idx] if errors[min_idx, fold] < 1e6 else pars[0]
+        min_error = min(errors[min_idx, fold], 1e6)
+        print('Best parameters for set {0} are {1}'.format(fold + 1, outpars))
         best_pars.append(outpars)
         error_list.append(min_error)
-        set += 1
 
     return best_pars, error_list
 
@@ -254,29 +655,163 @@ def optimization_randomsearch(imgs, grades, args, loss, groups=None):
     """
     # Unpack parameters
     n_pars = args.n_pars
-    n_jobs = args.n_jobs
+    n_jobs = effective_n_jobs(args.n_jobs)
     np.random.seed(args.seed)
     # Create parameter sets
     pars = make_pars(n_pars)
+    batches = parameter_batches(pars, n_jobs)
 
     min_error = 1e6
-    outpars = pars[0]
+    # Errors in the order of pars, unevaluated sets are not selected
+    all_errors = np.full(len(pars), np.inf)
+
+    # Saved errors
+    ckpt = checkpoint(args)
+    saved = load_search_state(ckpt, 'randomsearch', pars, batches)
+    digests = image_digests(imgs, args)
 
-    for k in tqdm(range(int(len(pars)/n_jobs)+1), desc='Optimizing parameters'):
-        k1 = np.min([k*n_jobs, len(pars)+1])
-        k2 = np.min([(k+1)*n_jobs, len(pars)])
-        if k1 < len(pars):
-            _pars = pars[k1:k2]
-            errors = Parallel(n_jobs=n_jobs)(delayed(fit_model)
-                                             (imgs, grades, p, args, loss, groups)
-                                             for p in _pars)
+    for k in tqdm(range(len(batches)), desc='Optimizing parameters'):
+        if k < len(saved):
+            errors = saved[k]
+        else:
+            errors = Parallel(n_jobs=n_jobs)(delayed(fit_models)
+                                             (imgs, grades, [pars[i] for i in task], args, loss, groups,
+                                              median_threads=worker_threads(args, len(batches[k])),
+                                              digests=digests)
+                                             for task in batches[k])
+            errors = np.concatenate(errors)
+            saved.append(errors)
+            save_search_state(ckpt, 'randomsearch', pars, batches, saved, k + 1)
+        all_errors[np.concatenate(batches[k])] = errors
+
+        _min_error = np.min(errors)
+        if _min_error < min_error:
+            min_error = _min_error
+            print('Current minimum error is: {0}'.format(min_error))
+
+    # First parameter set with minimum error, as in sequential search
+    min_idx = np.argmin(all_errors)
+    outpars = pars[min_idx] if all_errors[min_idx] < 1e6 else pars[0]
+
+    return outpars, min_error
 
-            min_idx = np.argmin(np.array(errors))
 
-            _min_error = errors[min_idx]
-            if _min_error < min_error:
-                outpars = _pars[min_idx]
-                min_error = _min_error
-                print('Current minimum error is: {0}'.format(min_error))
+def load_search_state(ckpt, name, pars, batches):
+    """Returns errors of parameter batches saved by save_search_state, or empty list if nothing is saved.
+
+    Raises an exception if the saved state was created with different parameter sets or batches.
+    """
+    state = ckpt.load(name) if ckpt is not None else None
+    if state is None:
+        return []
+    if state['pars'] != list(pars):
+        raise Exception('Checkpoint {0} was saved with different parameter sets!'.format(name))
+    if state.get('batches') != batches:
+        raise Exception('Checkpoint {0} was saved with different parameter batches (n_jobs)!'.format(name))
+    print('Resuming {0} from {1} evaluated chunks'.format(name, len(state['errors'])))
+    return list(state['errors'])
+
+
+def save_search_state(ckpt, name, pars, batches, errors, n_done):
+    """Saves parameter sets, batches and errors of evaluated batches every ckpt.every batches."""
+    if ckpt is None:
+        return
+    if n_done % ckpt.every == 0 or n_done >= len(batches):
+        ckpt.save(name, dict(pars=list(pars), batches=batches, errors=list(errors)))
+
+
+def optimization_halving(imgs, grades, args, loss, groups=None):
+    """Optimizes hyperparameters for MRELBP and local standardization using successive halving.
+
+    Random parameter sets are first scored on a cheap approximation of the data: a random subset of samples
+    (whole patient groups if groups are given) and central crops of the images. Only the best 1 / eta of the sets
+    are promoted to the next rung, where the number of samples and the crop size are increased by eta.
+    The last rung uses all samples at full resolution, so the returned error is comparable to
+    optimization_randomsearch. Minimum errors of the other rungs are calculated on different samples
+    and crops, so they are not comparable with each other or with the returned error.
+
+    Parameters
+    ----------
+    imgs : list
+        List of input images.
+    grades : ndarray
+        Ground truth
+    args : Namespace
+        Contains arguments for grading pipeline. See grading_pipelines for description.
+        halving_eta = Reduction factor between rungs.
+        halving_min_samples = Minimum number of samples in the cheapest rung.
+        halving_min_size = Minimum width and height of the cropped images.
+    loss : funciton
+        Loss function used in optimization. (e.g. mean squared error)
+    groups : ndarray
+        Patient groups used in leave-one-group-out split.
+    Returns
+    -------
+    Best parameters, error
+    """
+    # Unpack parameters
+    n_jobs = effective_n_jobs(args.n_jobs)
+    eta = args.halving_eta
+    np.random.seed(args.seed)
+    # Create parameter sets
+    pars = make_pars(args.n_pars)
+    random_state = np.random.RandomState(args.seed)
+
+    # Number of rungs, the last one at full fidelity
+    n_rungs = int(np.floor(np.log(len(pars)) / np.log(eta) + 1e-9)) + 1
+    n_samples = len(grades)
+    for rung in range(n_rungs):
+        fidelity = float(eta) ** (rung - n_rungs + 1)
+
+        # Sample subset
+        n_subset = min(n_samples, max(args.halving_min_samples, int(np.ceil(fidelity * n_samples))))
+        subset = halving_subset(n_samples, n_subset, random_state, groups=groups)
+        imgs_rung = [central_crop(imgs[i], np.sqrt(fidelity), args.halving_min_size) for i in subset]
+        groups_rung = groups[subset] if groups is not None else None
+        digests = image_digests(imgs_rung, args)
+
+        # Evaluate candidates
+        tasks = group_parameters(pars)
+        _errors = Parallel(n_jobs=n_jobs)(delayed(fit_models)
+                                          (imgs_rung, grades[subset], [pars[i] for i in task], args, loss, groups_rung,
+                                           median_threads=worker_threads(args, min(n_jobs, len(tasks))),
+                                           digests=digests)
+                                          for task in tasks)
+        errors = np.zeros(len(pars))
+        errors[np.concatenate(tasks)] = np.concatenate(_errors)
+        print('Rung {0}: {1} parameter sets, {2} samples, fidelity {3:.3f}, minimum rung error {4} '
+              '(not comparable between rungs)'.format(rung + 1, len(pars), len(subset), fidelity, np.min(errors)))
+
+        # Promote best sets
+        order = np.argsort(errors, kind='mergesort')
+        if rung < n_rungs - 1:
+            pars = [pars[i] for i in order[:max(1, len(pars) // eta)]]
+
+    min_error = errors[order[0]]
+    outpars = pars[order[0]]
+    print('Best parameters are {0}, error {1}'.format(outpars, min_error))
 
     return outpars, min_error
+
+
+def halving_subset(n_samples, n_subset, random_state, groups=None):
+    """Returns sorted indices of a random sample subset. Whole groups are selected if groups are given."""
+    if n_subset >= n_samples:
+        return np.arange(n_samples)
+    if groups is None:
+        return np.sort(random_state.choice(n_samples, n_subset, replace=False))
+
+    # Add random groups until the subset is large enough
+    subset = []
+    for group in random_state.permutation(np.unique(groups)):
+        subset.extend(np.where(groups == group)[0])
+        if len(subset) >= n_subset:
+            break
+    return np.sort(subset)
+
+
+def central_crop(image, fraction, min_size=0):
+    """Crops center of the image. Width and height are multiplied by fraction, but not below min_size."""
+    size = [min(s, max(min_size, int(np.ceil(s * fraction)))) for s in image.shape]
+    start = [(s - c) // 2 for s, c in zip(image.shape, size)]
+    return image[start[0]:start[0] + size[0], start[1]:start[1] + size[1]]
@@ -4,13 +4,13 @@ Contains functions used to writing and reading image stacks, images, h5 datasets
 """
 
 import numpy as np
-from struct import pack, unpack  # Binary writing
 import pandas as pd
 import os
 import cv2
 import h5py
 from tqdm import tqdm
 from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor
 from components.utilities.misc import bounding_box
 
 
@@ -103,13 +103,28 @@ def load_bbox(path, n_jobs=12):
             except ValueError:
                 continue
     files = newlist[:]  # replace list
-    # Load data and get bounding box
-    data = Parallel(n_jobs=n_jobs)(delayed(read_image)(path, file) for file in files)
-    data = np.transpose(np.array(data), (1, 2, 0))
-    angles = Parallel(n_jobs=n_jobs)(delayed(read_image_bbox)(path, file) for file in files)
-    angles = np.array(angles)
 
-    return data, (angles[:, 0], angles[:, 1], angles[:, 2], angles[:, 3])
+    # Preallocate stack (slices x height x width) based on the first image
+    first = read_image(path, files[0])
+    if first is None:
+        raise Exception('Could not read image: {0}'.format(os.path.join(path, files[0])))
+    data = np.zeros((len(files),) + first.shape, dtype=first.dtype)
+    bounds = np.zeros((len(files), 4), dtype=np.int64)
+
+    def load_slice(k):
+        """Decodes a slice into the stack and calculates its bounding box from the same buffer."""
+        image = first if k == 0 else read_image(path, files[k])
+        if image is None:
+            raise Exception('Could not read image: {0}'.format(os.path.join(path, files[k])))
+        data[k] = image
+        bounds[k] = bounding_box(data[k])
+
+    # Load data and get bounding box (cv2 releases GIL, so threads decode in parallel without copying slices)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(load_slice, range(len(files))))
+    data = np.transpose(data, (1, 2, 0))
+
+    return data, (bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
 
 
 def read_image(path, file):
@@ -159,99 +174,87 @@ def save(path, file_name, data, n_jobs=12):
                             for k in tqdm(range(nfiles), 'Saving dataset'))
 
 
-def load_binary(path, datatype=np.int32):
-    """Loads binary .dat file including an array as given datatype."""
-    if datatype == np.float64:
-        byte_array = np.fromfile(path, dtype=np.int64)  # read everything as int32
-    else:
-        byte_array = np.fromfile(path, dtype=np.int32)  # read everything as int32
-    w = byte_array[0]
-    h = int((byte_array.size - 1) / w)
-    with open(path, "rb") as f:  # open to read binary file
-        if datatype == np.float64:
-            f.seek(8)  # skip first integer (width)
-        else:
-            f.seek(4)  # skip first integer (width)
-        array = np.zeros((w, h))
-        for i in range(w):
-            for j in range(h):
-                if datatype == np.int32:
-                    array[i, j] = unpack('<i', f.read(4))[0]
-                    # when reading byte by byte (struct),
-                    # data type can be defined with every byte
-                elif datatype == np.float32:
-                    array[i, j] = unpack('<f', f.read(4))[0]
-                elif datatype == np.float64:
-                    array[i, j] = unpack('<d', f.read(8))[0]
-        return array
+# Value types of binary .dat files
+binary_types = {'int': np.dtype('<i4'), 'float': np.dtype('<f4'), 'double': np.dtype('<f8')}
+binary_dtypes = {np.dtype(np.int32): binary_types['int'], np.dtype(np.float32): binary_types['float'],
+                 np.dtype(np.float64): binary_types['double']}
+
+
+def load_binary(path, datatype=np.int32, mmap=False):
+    """Loads binary .dat file including an array as given datatype.
+
+    The file contains the array width as int32 (int64 for float64 data) followed by the array values in row-major
+    order. By default, the array is returned as float64. If mmap is True, a read-only np.memmap in the stored datatype
+    is returned instead, so that large images are not read into memory.
+    """
+    header = np.dtype('<i8') if datatype == np.float64 else np.dtype('<i4')
+    dtype = binary_dtypes.get(np.dtype(datatype))
+    w = int(np.fromfile(path, dtype=header, count=1)[0])
+    h = (os.path.getsize(path) // header.itemsize - 1) // w
+    if dtype is None:  # Unsupported datatype
+        return np.zeros((w, h))
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode='r', offset=header.itemsize, shape=(w, h))
+    return np.fromfile(path, dtype=dtype, count=w * h, offset=header.itemsize).reshape(w, h).astype(np.float64)
+
+
+def weights_dtype(width, n_components, n_eigenvectors=None, n_singular=None, n_weights=None):
+    """Structured dtype of the binary model file (see write_binary_weights).
+
+    Eigenvectors are stored feature by feature, i.e. as shape (width, n_eigenvectors).
+    Sizes of eigenvectors, singular values and weights default to the number of components.
+    """
+    n_eigenvectors = n_components if n_eigenvectors is None else n_eigenvectors
+    n_singular = n_components if n_singular is None else n_singular
+    n_weights = n_components if n_weights is None else n_weights
+    return np.dtype([('width', '<i4'),
+                     ('n_components', '<i4'),
+                     ('eigenvectors', '<f4', (width, n_eigenvectors)),
+                     ('singular_values', '<f4', (n_singular,)),
+                     ('weights', '<f8', (n_weights,)),
+                     ('weights_log', '<f8', (n_weights,)),
+                     ('mean', '<f8', (width,)),
+                     ('intercepts', '<f8', (2,))])
 
 
 def load_binary_weights(path):
     """Loads linear regression weights and PCA variables from binary .dat file."""
-    # bytesarray64 = np.fromfile(path, dtype=np.int64)  # read everything as int64
-    bytesarray32 = np.fromfile(path, dtype=np.int32)  # read everything as int32
-    w = bytesarray32[0]
-    ncomp = bytesarray32[1]
-    with open(path, "rb") as f:  # open to read binary file
-        f.seek(8)  # skip first two integers (width)
-        eigenvec = np.zeros((w, ncomp))
-        for i in range(w):
-            for j in range(ncomp):
-                eigenvec[i, j] = unpack('<f', f.read(4))[0]
-        singularvalues = np.zeros(ncomp)
-        for i in range(ncomp):
-            singularvalues[i] = unpack('<f', f.read(4))[0]
-        weights = np.zeros(ncomp)
-        for i in range(ncomp):
-            weights[i] = unpack('<d', f.read(8))[0]
-        weights_log = np.zeros(ncomp)
-        for i in range(ncomp):
-            weights_log[i] = unpack('<d', f.read(8))[0]
-        mean = np.zeros(w)
-        for i in range(w):
-            mean[i] = unpack('<d', f.read(8))[0]
-        intercept_lin = unpack('<d', f.read(8))[0]
-        intercept_log = unpack('<d', f.read(8))[0]
-        return w, ncomp, eigenvec, singularvalues, weights, weights_log, mean, [intercept_lin, intercept_log]
+    w, ncomp = np.fromfile(path, dtype='<i4', count=2)
+    model = np.fromfile(path, dtype=weights_dtype(w, ncomp), count=1)[0]
+    eigenvec = model['eigenvectors'].reshape(w, ncomp).astype(np.float64)
+    singularvalues = model['singular_values'].reshape(ncomp).astype(np.float64)
+    weights = model['weights'].reshape(ncomp).astype(np.float64)
+    weights_log = model['weights_log'].reshape(ncomp).astype(np.float64)
+    mean = model['mean'].reshape(w).astype(np.float64)
+    intercept_lin, intercept_log = [float(i) for i in model['intercepts']]
+    return w, ncomp, eigenvec, singularvalues, weights, weights_log, mean, [intercept_lin, intercept_log]
 
 
 def write_binary_weights(path, ncomp, eigenvectors, singularvalues, weights, weights_log, mean, intercepts):
     """Saves linear regression weights and PCA variables into a binary .dat file."""
     # Input eigenvectors in shape: components, features
-    with open(path, "wb") as f:
-        f.write(pack('<i', eigenvectors.shape[1]))  # Width
-        f.write(pack('<i', ncomp))  # Number of components
-        # Eigenvectors
-        for j in range(eigenvectors.shape[1]):
-            for i in range(eigenvectors.shape[0]):  # Write row by row, component at a time
-                f.write(pack('<f', eigenvectors[i, j]))
-        # Singular values
-        for i in range(singularvalues.shape[0]):
-            f.write(pack('<f', singularvalues[i]))
-        # Weights
-        for i in range(weights.shape[0]):
-            f.write(pack('<d', weights[i]))
-        for i in range(weights_log.shape[0]):
-            f.write(pack('<d', weights_log[i]))
-        for i in range(mean.shape[0]):
-            f.write(pack('<d', mean[i]))
-        f.write(pack('<d', intercepts[0]))  # Linear intercept
-        f.write(pack('<d', intercepts[1]))  # Logistic intercept
+    if weights.shape[0] != weights_log.shape[0]:
+        raise Exception('Linear and logistic weights should have the same length!')
+    model = np.zeros(1, dtype=weights_dtype(eigenvectors.shape[1], ncomp, n_eigenvectors=eigenvectors.shape[0],
+                                            n_singular=singularvalues.shape[0], n_weights=weights.shape[0]))
+    model['width'] = eigenvectors.shape[1]  # Width
+    model['n_components'] = ncomp  # Number of components
+    model['eigenvectors'] = eigenvectors.T  # Feature at a time
+    model['singular_values'] = singularvalues
+    model['weights'] = weights
+    model['weights_log'] = weights_log
+    model['mean'] = mean
+    model['intercepts'] = intercepts[:2]  # Linear and logistic intercept
+    model.tofile(path)
 
 
 def write_binary_image(path, image, dtype='int'):
     """Saves a numpy array as binary .dat file in given datatype."""
     with open(path, "wb") as f:
-        f.write(pack('<i', image.shape[0]))  # Width
-        # Image values as float
-        for i in range(image.shape[0]):
-            for j in range(image.shape[1]):
-                if dtype == 'float':
-                    f.write(pack('<f', image[i, j]))
-                if dtype == 'double':
-                    f.write(pack('<d', image[i, j]))
-                if dtype == 'int':
-                    f.write(pack('<i', image[i, j]))
+        np.array(image.shape[0], dtype='<i4').tofile(f)  # Width
+        # Image values row by row
+        if dtype in binary_types:
+            np.ascontiguousarray(image, dtype=binary_types[dtype]).tofile(f)
 
 
 def load_vois_h5(pth, sample):
@@ -164,17 +164,40 @@ def create_subimages(image, n_x=3, n_y=3, im_size_x=400, im_size_y=400):
     im_size_y : int
         Height of the subimages.
     """
-    swipe_range_x = image.shape[0] - im_size_x
+    windows = subimage_windows(image.shape, n_x=n_x, n_y=n_y, im_size_x=im_size_x, im_size_y=im_size_y)
+    return [image[x0:x1, y0:y1] for x0, x1, y0, y1 in windows]
+
+
+def subimage_windows(shape, n_x=3, n_y=3, im_size_x=400, im_size_y=400):
+    """Returns the subimage locations used in create_subimages.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the input image.
+    n_x : int
+        Number of subimages along x-axis.
+    n_y : int
+        Number of subimages along y-axis.
+    im_size_x : int
+        Width of the subimages.
+    im_size_y : int
+        Height of the subimages.
+    Returns
+    -------
+    List of windows (x_start, x_stop, y_start, y_stop). x refers to the first image axis.
+    """
+    swipe_range_x = shape[0] - im_size_x
     swipe_x = swipe_range_x // n_x
-    swipe_range_y = image.shape[1] - im_size_y
+    swipe_range_y = shape[1] - im_size_y
     swipe_y = swipe_range_y // n_y
-    subimages = []
+    windows = []
     for x in range(n_x):
         for y in range(n_y):
             x_ind = swipe_x * x
             y_ind = swipe_y * y
-            subimages.append(image[x_ind:x_ind + im_size_x, y_ind:y_ind + im_size_y])
-    return subimages
+            windows.append((x_ind, x_ind + im_size_x, y_ind, y_ind + im_size_y))
+    return windows
 
 
 def print_images(images, masks=None, title=None, subtitles=None, save_path=None, sample=None, transparent=False,
@@ -21,7 +21,7 @@ from sklearn.metrics import roc_auc_score, roc_curve, precision_recall_curve, av
 import components.grading.args_grading as arg
 import components.utilities.listbox as listbox
 
-from components.grading.grading_pipelines import pipeline_lbp, pipeline_prediction
+from components.grading.grading_pipelines import pipeline_lbp, pipeline_lbp_subimages, pipeline_prediction
 from components.grading.roc_curve import roc_curve_single, roc_curve_multi, calc_curve_bootstrap, plot_vois
 from components.utilities.load_write import load_excel
 
@@ -57,7 +57,12 @@ if __name__ == '__main__':
         groups = None
 
     # Get file list
-    if arguments.n_subvolumes > 1:
+    if arguments.n_subvolumes > 1 and arguments.subimage_features == 'integral':
+        # Subimage features from full images
+        arguments.save_path = arguments.save_path + '_' + str(arguments.n_subvolumes) + 'subs'
+        arguments.feature_path = arguments.save_path + '/Features'
+        file_list = [os.path.basename(f) for f in glob(arguments.image_path + '/' + '*.h5')]
+    elif arguments.n_subvolumes > 1:
         arguments.save_path = arguments.save_path + '_' + str(arguments.n_subvolumes) + 'subs'
         arguments.feature_path = arguments.save_path + '/Features'
         file_list = []
@@ -93,7 +98,10 @@ if __name__ == '__main__':
         grade_selection = arguments.grades_used[k]
         print('Processing against grades: {0}'.format(grade_selection))
 
-        pipeline_lbp(arguments, file_list, pars, grade_selection)
+        if arguments.n_subvolumes > 1 and arguments.subimage_features == 'integral':
+            pipeline_lbp_subimages(arguments, file_list, pars, grade_selection)
+        else:
+            pipeline_lbp(arguments, file_list, pars, grade_selection)
 
         # Get predictions
         grade, pred, _ = pipeline_prediction(arguments, grade_selection, pat_groups=groups, combiner=combinator)
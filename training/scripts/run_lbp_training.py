@@ -5,7 +5,7 @@ import components.grading.args_grading as arg
 
 from glob import glob
 from sklearn.metrics import mean_squared_error
-from components.lbptraining.training_components import optimization_randomsearch_loo
+from components.lbptraining.training_components import optimization_randomsearch_loo, optimization_halving
 from components.utilities import listbox
 from components.utilities.load_write import load_vois_h5, load_excel
 from components.utilities.misc import auto_corner_crop
@@ -15,6 +15,7 @@ def pipeline(arguments, files, loss, pat_groups=None):
     """Pipeline for random search optimization.
     1. Loads images and ground truth.
     2. Calls the optimization function and displays result.
+    Uses leave-one-out random search, or successive halving if arguments.search is 'halving'.
 
     Parameters
     ----------
@@ -68,7 +69,11 @@ def pipeline(arguments, files, loss, pat_groups=None):
     else:
         raise Exception('Check selected zone!')
     # Optimize parameters
-    pars, error = optimization_randomsearch_loo(np.array(images), grades, arguments, loss, groups=pat_groups)
+    if arguments.search == 'halving':
+        pars, error = optimization_halving(np.array(images), grades, arguments, loss, groups=pat_groups)
+        pars, error = [pars], [error]
+    else:
+        pars, error = optimization_randomsearch_loo(np.array(images), grades, arguments, loss, groups=pat_groups)
 
     print('Results for grades: ' + arguments.grades_used)
     print("Minimum error is : {0}".format(error))
@@ -15,7 +15,7 @@ from glob import glob
 from datetime import date
 from time import strftime
 from sklearn.metrics import mean_squared_error
-from components.lbptraining.training_components import optimization_hyperopt_loo
+from components.lbptraining.training_components import optimization_hyperopt_loo, optimization_halving
 from components.utilities import listbox
 from components.utilities.load_write import load_vois_h5, load_excel
 from components.utilities.misc import auto_corner_crop
@@ -25,6 +25,7 @@ def pipeline_hyperopt(args, files, metric, pat_groups=None):
     """Pipeline for Bayesian optimization.
     1. Loads images and ground truth.
     2. Calls the optimization function and displays result.
+    Uses successive halving instead if args.search is 'halving'.
 
     Parameters
     ----------
@@ -82,7 +83,11 @@ def pipeline_hyperopt(args, files, metric, pat_groups=None):
     else:
         raise Exception('Check selected zone!')
     # Optimize parameters
-    pars, error = optimization_hyperopt_loo(np.array(images), grades, args, metric, groups=pat_groups)
+    if args.search == 'halving':
+        pars, error = optimization_halving(np.array(images), grades, args, metric, groups=pat_groups)
+        pars, error = [pars], [error]
+    else:
+        pars, error = optimization_hyperopt_loo(np.array(images), grades, args, metric, groups=pat_groups)
 
     print('Results for grades: ' + args.grades_used)
     print("Parameters are:\n", pars)
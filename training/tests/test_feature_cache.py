@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from types import SimpleNamespace
+
+from components.lbptraining.feature_cache import FeatureCache, parameter_key, image_digest, image_digests
+
+parameters = {'N': 8, 'R': 9, 'r': 3, 'wc': 5, 'wl': 3, 'ws': 7, 'ks1': 13, 'sigma1': 4, 'ks2': 19, 'sigma2': 6}
+options = dict(normalize=True, normalization='direct', median_method='scipy')
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return FeatureCache(str(tmpdir))
+
+
+@pytest.fixture
+def image():
+    return np.arange(12, dtype=np.float64).reshape(3, 4)
+
+
+def test_key_is_stable(cache, image):
+    # Keys address files of existing caches, so they must not change between versions
+    assert parameter_key(parameters, **options) == \
+        '{"N": 8, "R": 9, "ks1": 13, "ks2": 19, "median_method": "scipy", "normalization": "direct", ' \
+        '"normalize": true, "r": 3, "sigma1": 4, "sigma2": 6, "wc": 5, "wl": 3, "ws": 7}'
+    assert image_digest(image) == 'ba48ae9a2f65db410a249a036c862ae3a9cb08bb'
+    assert cache.key(image, parameters, **options) == 'ddc7a6715bb826fbe25820ee2ba1787bc0a89693'
+
+
+def test_key_ignores_representation(cache, image):
+    key = cache.key(image, parameters, **options)
+    reordered = dict(reversed(list(parameters.items())))
+    numpy_types = {k: np.int64(v) for k, v in parameters.items()}
+    floats = {k: float(v) for k, v in parameters.items()}
+    seeded = dict(parameters, seed=42)
+    for pars in [reordered, numpy_types, floats, seeded]:
+        assert cache.key(image, pars, **options) == key
+    assert cache.key(np.asfortranarray(image), parameters, **options) == key
+
+
+def test_key_depends_on_inputs(cache, image):
+    key = cache.key(image, parameters, **options)
+    assert cache.key(image + 1, parameters, **options) != key
+    assert cache.key(image.reshape(4, 3), parameters, **options) != key
+    assert cache.key(image.astype(np.float32), parameters, **options) != key
+    assert cache.key(image, dict(parameters, wc=7), **options) != key
+    assert cache.key(image, parameters, **dict(options, normalization='separable')) != key
+
+
+def test_key_from_digest(cache, image, tmpdir):
+    digests = image_digests([image, image + 1], SimpleNamespace(feature_cache=str(tmpdir)))
+    assert digests == [image_digest(image), image_digest(image + 1)]
+    assert cache.key(None, parameters, digest=digests[0], **options) == cache.key(image, parameters, **options)
+    assert image_digests([image], SimpleNamespace(feature_cache=None)) is None
+
+
+def test_put_get(cache, image):
+    key = cache.key(image, parameters, **options)
+    assert cache.get(key) is None
+    features = np.random.RandomState(0).rand(1, 32)
+    cache.put(key, features)
+    np.testing.assert_array_equal(cache.get(key), features)
+    # Features are calculated only once
+    calls = []
+    cached = cache.features(image, parameters, lambda i, p: calls.append(1), **options)
+    np.testing.assert_array_equal(cached, features)
+    assert len(calls) == 0
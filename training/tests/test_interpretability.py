@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from sklearn.decomposition import PCA
+from sklearn.model_selection import LeaveOneGroupOut
+
+from components.grading.interpretability import explain_logo, submit
+
+
+@pytest.mark.parametrize('whitening', [True, False])
+def test_shap_additivity(whitening):
+    random_state = np.random.RandomState(0)
+    features = np.dot(random_state.randn(40, 6), random_state.randn(6, 6)) + 5
+    groups = np.repeat(np.arange(8), 5)
+    splits = list(LeaveOneGroupOut().split(features, groups=groups))
+
+    pca = PCA(n_components=4, whiten=whitening).fit(features)
+    score = pca.transform(features)
+    coefs = random_state.randn(len(splits), 1, 4)  # Logistic regression coef_ shape
+    coefs_lin = random_state.randn(len(splits), 4)
+
+    shap_values, shap_values_lin = explain_logo(features, splits, coefs, coefs_lin, pca)
+    assert shap_values.shape == shap_values_lin.shape == (len(features), features.shape[1])
+
+    # Values sum to f(x) - E[f(x)], expectation over the training split
+    for values, weights in [(shap_values, coefs), (shap_values_lin, coefs_lin)]:
+        expected = []
+        for (train_idx, test_idx), w in zip(splits, weights.reshape(len(splits), -1)):
+            expected.extend(score[test_idx] @ w - np.mean(score[train_idx] @ w))
+        np.testing.assert_allclose(values.sum(1), expected, atol=1e-10)
+
+
+def test_deferred_explanation():
+    random_state = np.random.RandomState(0)
+    features = random_state.randn(20, 5)
+    splits = list(LeaveOneGroupOut().split(features, groups=np.repeat(np.arange(4), 5)))
+    pca = PCA(n_components=3, whiten=True).fit(features)
+    coefs, coefs_lin = random_state.randn(len(splits), 1, 3), random_state.randn(len(splits), 3)
+
+    future = submit(explain_logo, features, splits, coefs, coefs_lin, pca)
+    for deferred, direct in zip(future.result(), explain_logo(features, splits, coefs, coefs_lin, pca)):
+        np.testing.assert_array_equal(deferred, direct)
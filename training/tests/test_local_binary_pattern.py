@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from components.grading import local_binary_pattern
+from components.grading.local_binary_pattern import local_normalize_abs, gauss_filter, gauss_kernel_1d, MRELBP, \
+    MRELBP_fused
+
+
+@pytest.fixture
+def image():
+    return np.random.RandomState(42).rand(120, 130) + 1
+
+
+@pytest.mark.parametrize('parameters', [dict(ks1=13, sigma1=2, ks2=19, sigma2=3),
+                                        dict(ks1=25, sigma1=4, ks2=5, sigma2=5),
+                                        dict(ks1=9, sigma1=7, ks2=23, sigma2=1)])
+def test_separable_normalization(image, parameters):
+    direct = local_normalize_abs(image, parameters, method='direct')
+    separable = local_normalize_abs(image, parameters, method='separable')
+    np.testing.assert_allclose(separable, direct, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('parameters', [dict(ks1=9, sigma1=7, ks2=5, sigma2=3),
+                                        dict(ks1=25, sigma1=1, ks2=13, sigma2=1)])
+def test_recursive_normalization_fallback(image, parameters):
+    # Truncated kernels and small sigmas use the separable filter
+    direct = local_normalize_abs(image, parameters, method='direct')
+    recursive = local_normalize_abs(image, parameters, method='recursive')
+    np.testing.assert_allclose(recursive, direct, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('sigma', [2, 3, 4])
+@pytest.mark.parametrize('normalize', ['gaussian', 'sum'])
+def test_recursive_filter(image, sigma, normalize):
+    kernel = gauss_kernel_1d(6 * sigma + 1, sigma, normalize=normalize)
+    separable = gauss_filter(image, kernel, sigma, method='separable')
+    recursive = gauss_filter(image, kernel, sigma, method='recursive')
+    np.testing.assert_allclose(recursive, separable, rtol=0.015)
+
+
+def test_recursive_normalization(image):
+    parameters = dict(ks1=19, sigma1=3, ks2=25, sigma2=4)
+    direct = local_normalize_abs(image, parameters, method='direct')
+    recursive = local_normalize_abs(image, parameters, method='recursive')
+    np.testing.assert_allclose(recursive, direct, rtol=0, atol=0.05)
+
+
+@pytest.mark.parametrize('parameters', [dict(N=8, R=9, r=3, wc=5, wl=3, ws=5),
+                                        dict(N=8, R=4, r=1, wc=3, wl=5, ws=3),
+                                        dict(N=8, R=7, r=6, wc=3, wl=3, ws=7)])
+@pytest.mark.parametrize('normalize', [True, False])
+def test_fused_kernel(monkeypatch, parameters, normalize):
+    # Python version of the kernel, so that it is tested without Numba
+    monkeypatch.setattr(local_binary_pattern, 'njit', lambda function: function)
+    monkeypatch.setattr(local_binary_pattern, '_mrelbp_fused_kernel', local_binary_pattern._mrelbp_fused_pass)
+    image = np.random.RandomState(0).rand(48, 52)
+    fused = MRELBP_fused(image, parameters, normalize=normalize)
+    reference = MRELBP(image, parameters, normalize=normalize)
+    assert fused.shape == reference.shape == (1, 32)
+    np.testing.assert_array_equal(fused, reference)
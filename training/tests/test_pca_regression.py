@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+
+from types import SimpleNamespace
+
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import LeaveOneOut, LeaveOneGroupOut
+
+from components.grading.pca_regression import ridge_cv, standardize, evaluate_model, CompiledModel, scikit_pca, \
+    rebatch, logistic_folds
+from components.utilities.load_write import load_binary_weights, write_binary_weights
+
+
+def ridge_refit(x, y, alpha, use_intercept=True):
+    """Ridge(alpha, normalize=True) of scikit-learn 0.20, fitted directly."""
+    if not use_intercept:
+        return np.linalg.solve(np.dot(x.T, x) + alpha * np.eye(x.shape[1]), np.dot(x.T, y)), 0.0
+    mean_x, mean_y = x.mean(0), y.mean()
+    x_centered = x - mean_x
+    norms = np.sqrt(np.sum(x_centered ** 2, axis=0))
+    norms[norms == 0] = 1.0
+    x_scaled = x_centered / norms
+    coef = np.linalg.solve(np.dot(x_scaled.T, x_scaled) + alpha * np.eye(x.shape[1]),
+                           np.dot(x_scaled.T, y - mean_y)) / norms
+    return coef, mean_y - np.dot(mean_x, coef)
+
+
+@pytest.fixture
+def data():
+    random_state = np.random.RandomState(42)
+    features = random_state.rand(30, 6) * [1, 10, 100, 0.1, 1, 1] + 5
+    features[:, -1] = 3  # Constant column
+    grades = np.dot(features, random_state.rand(6)) + random_state.randn(30)
+    groups = np.repeat(np.arange(10), 3)
+    return features, grades, groups
+
+
+@pytest.mark.parametrize('split', ['loo', 'logo'])
+@pytest.mark.parametrize('use_intercept', [True, False])
+@pytest.mark.parametrize('alpha', [0.01, 1.0])
+def test_ridge_downdate(data, split, use_intercept, alpha):
+    features, grades, groups = data
+    if split == 'loo':
+        splits = list(LeaveOneOut().split(features))
+    else:
+        splits = list(LeaveOneGroupOut().split(features, grades, groups))
+
+    predictions, coefs, intercepts = ridge_cv(features, grades, [test for _, test in splits], alpha=alpha,
+                                              use_intercept=use_intercept)
+
+    for fold, (train, test) in enumerate(splits):
+        coef, intercept = ridge_refit(features[train], grades[train], alpha, use_intercept)
+        np.testing.assert_allclose(coefs[fold], coef, rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(intercepts[fold], intercept, rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(predictions[fold], np.dot(features[test], coef) + intercept, rtol=1e-8)
+
+
+def evaluate_reference(features, args, model_path):
+    """Step by step evaluation of a saved model (features x samples)."""
+    _, _, eigen_vectors, sv_scaled, weights, weights_log, _, [intercept_lin, intercept_log] \
+        = load_binary_weights(model_path)
+    if args.standardization == 'centering':
+        features = features.T - np.mean(features, 1)
+    else:
+        features = standardize(features.T, axis=0)
+    score = np.matmul(features, eigen_vectors / sv_scaled) if args.use_PCA else features
+    pred_linear = np.matmul(score, weights) + intercept_lin
+    pred_logistic = (1 + np.exp(-(np.matmul(score, weights_log) + intercept_log))) ** -1
+    return pred_linear, pred_logistic, score
+
+
+
+@pytest.mark.parametrize('use_intercept', [True, False])
+def test_logistic_warm_start(data, use_intercept):
+    features, grades, groups = data
+    features = standardize(features[:, :-1], axis=0)
+    labels = grades > np.median(grades)
+    train_sets = [(features[train_idx], labels[train_idx])
+                  for train_idx, _ in LeaveOneGroupOut().split(features, labels, groups)]
+
+    models = logistic_folds(train_sets, features, labels, use_intercept=use_intercept)
+    for (x_train, y_train), model in zip(train_sets, models):
+        cold = LogisticRegression(solver='newton-cg', max_iter=1000, random_state=42, fit_intercept=use_intercept,
+                                  tol=1e-10).fit(x_train, y_train)
+        np.testing.assert_allclose(model.coef_, cold.coef_, atol=1e-3)
+        np.testing.assert_allclose(model.intercept_, cold.intercept_, atol=1e-3)
+
+
+@pytest.fixture
+def model_path(tmpdir):
+    random_state = np.random.RandomState(42)
+    n_features, n_components = 28, 5
+    path = str(tmpdir.join('model_weights.dat'))
+    write_binary_weights(path, n_components, random_state.randn(n_components, n_features),
+                         random_state.rand(n_components) + 0.5, random_state.randn(n_components),
+                         random_state.randn(n_components), random_state.rand(n_features), [0.3, -0.2])
+    return path
+
+
+@pytest.mark.parametrize('standardization', ['centering', 'standardize'])
+def test_compiled_model(model_path, standardization):
+    args = SimpleNamespace(standardization=standardization, use_PCA=True)
+    features = np.random.RandomState(0).rand(28, 12)
+
+    reference = evaluate_reference(features, args, model_path)
+    for result in [evaluate_model(features, args, model_path),
+                   CompiledModel(model_path, standardization=standardization).predict(features)]:
+        for value, expected in zip(result, reference):
+            np.testing.assert_allclose(value, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_compiled_model_subvolumes(model_path):
+    args = SimpleNamespace(standardization='centering', use_PCA=True)
+    subvolumes = [np.random.RandomState(k).rand(28, 12) for k in range(3)]
+    index = np.concatenate([np.full(12, k) for k in range(3)])
+
+    # Subvolumes are predicted separately and averaged
+    reference = [np.mean(values, axis=0) for values in
+                 zip(*[evaluate_reference(features, args, model_path) for features in subvolumes])]
+    result = CompiledModel(model_path).predict_batch(np.concatenate(subvolumes, axis=1), index)
+    for value, expected in zip(result, reference):
+        np.testing.assert_allclose(value, expected, rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('n_components', [3, 0.9])
+def test_incremental_pca(n_components):
+    random_state = np.random.RandomState(0)
+    features = standardize(np.dot(random_state.randn(200, 8), random_state.randn(8, 8)), axis=0)
+
+    pca, score = scikit_pca(features, n_components, whitening=True)
+    pca_inc, score_inc = scikit_pca(features, n_components, whitening=True, solver='incremental', batch_size=30)
+
+    assert pca_inc.n_components_ == pca.n_components_
+    signs = np.sign(np.sum(pca.components_ * pca_inc.components_, axis=1))
+    np.testing.assert_allclose(pca_inc.components_ * signs[:, None], pca.components_, atol=1e-8)
+    np.testing.assert_allclose(pca_inc.explained_variance_, pca.explained_variance_, rtol=1e-8)
+    np.testing.assert_allclose(score_inc * signs, score, atol=1e-8)
+
+
+@pytest.mark.parametrize('sizes', [[1000], [7, 3, 250, 2, 120], [40], [0, 64, 0, 64]])
+def test_rebatch(sizes):
+    data = np.arange(sum(sizes) * 2, dtype=np.float64).reshape(-1, 2)
+    batches = np.split(data, np.cumsum(sizes)[:-1])
+    out = list(rebatch(batches, 50))
+
+    np.testing.assert_array_equal(np.concatenate(out), data)
+    if len(data) >= 50:
+        assert all(len(batch) == 50 for batch in out[:-1]) and 50 <= len(out[-1]) < 100
+    if len(sizes) == 1:  # Large batches are split into views
+        assert all(np.shares_memory(batch, data) for batch in out[:-1])